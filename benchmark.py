@@ -0,0 +1,336 @@
+# Local swarm simulation to measure download performance on localhost
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import bencoding
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PUBLIC_IP = "127.0.0.1"  # Address the tracker sees and hands out to peers
+HIDDEN_IP = "127.0.0.2"  # Address clients actually listen on when traffic is shaped (all of 127/8 is loopback on Linux)
+PROXY_CHUNK = 16384  # Bytes moved at a time by the shaping proxy
+
+
+class ShapingProxy:
+    """
+    Forwards connections from (PUBLIC_IP, port) to (HIDDEN_IP, port), delaying every chunk by the latency and limiting
+    the rate in each direction. Since the tracker records the address a client announces from, peers end up talking
+    to each other through this proxy without the client knowing about it.
+    """
+
+    def __init__(self, port, latency=0.0, bandwidth=None):
+        self.port_ = port
+        self.latency_ = latency  # seconds, one way
+        self.bandwidth_ = bandwidth  # bytes per second per direction, None for unlimited
+        self.server_ = None
+
+    async def start(self):
+        self.server_ = await asyncio.start_server(self.handle_connection, PUBLIC_IP, self.port_)
+
+    async def stop(self):
+        if self.server_:
+            self.server_.close()
+            await self.server_.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            remote_reader, remote_writer = await asyncio.open_connection(HIDDEN_IP, self.port_)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(self.pipe(reader, remote_writer), self.pipe(remote_reader, writer))
+
+    async def pipe(self, reader, writer):
+        # Reading and writing are separate, so that chunks are delayed as they travel instead of one after another
+        queue = asyncio.Queue()  # (arrival time, chunk) pairs, then None once the sender is done
+        await asyncio.gather(self.receive(reader, queue), self.forward(queue, writer))
+
+    async def receive(self, reader, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await reader.read(PROXY_CHUNK)
+                if not chunk:
+                    break
+                queue.put_nowait((loop.time(), chunk))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            queue.put_nowait(None)
+
+    async def forward(self, queue, writer):
+        # A chunk is sent once the link is free and it had time to go through it at the bandwidth, and delivered
+        # latency seconds later. Chunks keep being taken from the queue after the receiving end hung up, so that the
+        # sending end can finish
+        loop = asyncio.get_running_loop()
+        link_free = 0.0
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if writer.is_closing():
+                    continue
+                arrival, chunk = item
+                sent = arrival
+                if self.bandwidth_:
+                    link_free = max(arrival, link_free) + len(chunk) / self.bandwidth_
+                    sent = link_free
+                delay = sent + self.latency_ - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    writer.write(chunk)
+                    await writer.drain()
+                except ConnectionError:
+                    writer.close()
+        finally:
+            writer.close()
+
+
+def process_stats(pid):
+    # CPU seconds and peak RSS (in kB) of a running process, read from /proc so it is only available on Linux
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        peak_rss = None
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak_rss = int(line.split()[1])
+        return cpu, peak_rss
+    except (OSError, ValueError, IndexError):
+        return None, None
+
+
+class Swarm:
+
+    def __init__(self, workdir, *, seeders=1, leechers=1, file_size=2**22, piece_length=bencoding.TORRENT_PIECE_LENGTH,
+                 tracker_port=42421, base_port=43000, latency=0.0, bandwidth=None, timeout=120.0, super_seed=False,
+                 interval=5, debug=False):
+        self.workdir_ = workdir
+        self.num_seeders_ = seeders
+        self.num_leechers_ = leechers
+        self.file_size_ = file_size
+        self.piece_length_ = piece_length
+        self.tracker_port_ = tracker_port
+        self.base_port_ = base_port
+        self.shaped_ = bool(latency or bandwidth)
+        self.latency_ = latency
+        self.bandwidth_ = bandwidth
+        self.timeout_ = timeout
+        self.super_seed_ = super_seed
+        self.interval_ = interval  # Tracker interval, short so that leechers find each other quickly
+        self.debug_ = debug
+
+        self.filename_ = "payload.bin"
+        self.torrent_ = None
+        self.tracker_ = None
+        self.seeders_ = []  # (port, process) pairs
+        self.leechers_ = []  # (port, process, directory) triples
+        self.proxies_ = []
+
+    def generate_files(self):
+        # create_torrent_file works relative to the current directory and reads the piece length from the module
+        cwd = os.getcwd()
+        old_piece_length = bencoding.TORRENT_PIECE_LENGTH
+        try:
+            os.chdir(self.workdir_)
+            with open(self.filename_, "wb") as f:
+                remaining = self.file_size_
+                while remaining > 0:
+                    n = min(remaining, 2**20)
+                    f.write(os.urandom(n))
+                    remaining -= n
+            bencoding.TORRENT_PIECE_LENGTH = self.piece_length_
+            with contextlib.redirect_stdout(sys.stderr):  # Keep stdout for the report
+                bencoding.create_torrent_file(self.filename_, tracker_url=f"http://{PUBLIC_IP}:{self.tracker_port_}")
+        finally:
+            bencoding.TORRENT_PIECE_LENGTH = old_piece_length
+            os.chdir(cwd)
+        self.torrent_ = os.path.join(self.workdir_, f"{self.filename_}.torrent")
+
+    def spawn(self, args, cwd):
+        return subprocess.Popen([sys.executable, "-u", *args], cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=None if self.debug_ else subprocess.DEVNULL)
+
+    def spawn_client(self, port, cwd, seeding):
+        listen_ip = HIDDEN_IP if self.shaped_ else PUBLIC_IP
+        args = [os.path.join(HERE, "client.py"), self.torrent_, "--ip", listen_ip, "-p", str(port)]
+        if seeding:
+            args += ["-f", self.filename_]
+            if self.super_seed_:
+                args.append("--super-seed")
+        return self.spawn(args, cwd)
+
+    async def wait_for_line(self, process, text, timeout):
+        # Reads the client's output until `text` shows up, returns False if it exits or times out first
+        async def read():
+            while True:
+                line = await asyncio.to_thread(process.stdout.readline)
+                if not line:
+                    return False
+                if self.debug_:
+                    print(line.decode(), end="")
+                if text in line:
+                    return True
+        try:
+            return await asyncio.wait_for(read(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_for_port(self, port, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                _, writer = await asyncio.open_connection(PUBLIC_IP, port)
+                writer.close()
+                return True
+            except OSError:
+                await asyncio.sleep(0.05)
+        return False
+
+    async def wait_for_seeder(self, port, process):
+        # Clients start listening right before announcing themselves. If a leecher asks the tracker before a seeder
+        # got registered, it finds the seeder on its next request, `interval` seconds later
+        listen_ip = HIDDEN_IP if self.shaped_ else PUBLIC_IP
+        deadline = time.monotonic() + 10.0
+        while time.monotonic() < deadline and process.poll() is None:
+            try:
+                _, writer = await asyncio.open_connection(listen_ip, port)
+                writer.close()
+                return True
+            except OSError:
+                await asyncio.sleep(0.05)
+        return False
+
+    async def run(self):
+        self.generate_files()
+        self.tracker_ = self.spawn([os.path.join(HERE, "tracker.py"), "--ip", PUBLIC_IP,
+                                    "-p", str(self.tracker_port_), "--interval", str(self.interval_)], self.workdir_)
+        if not await self.wait_for_port(self.tracker_port_):
+            raise RuntimeError("Tracker did not start")
+
+        ports = range(self.base_port_, self.base_port_ + self.num_seeders_ + self.num_leechers_)
+        if self.shaped_:
+            for port in ports:
+                proxy = ShapingProxy(port, self.latency_, self.bandwidth_)
+                await proxy.start()
+                self.proxies_.append(proxy)
+
+        setup_start = time.monotonic()
+        for port in ports[:self.num_seeders_]:
+            self.seeders_.append((port, self.spawn_client(port, self.workdir_, seeding=True)))
+        for port, process in self.seeders_:
+            if not await self.wait_for_seeder(port, process):
+                raise RuntimeError(f"Seeder on port {port} did not start")
+        setup_time = time.monotonic() - setup_start
+
+        start = time.monotonic()
+        for port in ports[self.num_seeders_:]:
+            directory = os.path.join(self.workdir_, f"leecher-{port}")
+            os.mkdir(directory)
+            self.leechers_.append((port, self.spawn_client(port, directory, seeding=False), directory))
+        results = await asyncio.gather(*[self.measure_leecher(port, process, directory, start)
+                                         for port, process, directory in self.leechers_])
+        total_time = time.monotonic() - start
+
+        seeder_stats = []
+        for port, process in self.seeders_:
+            cpu, peak_rss = process_stats(process.pid)
+            seeder_stats.append({"port": port, "cpu_seconds": cpu, "peak_rss_kb": peak_rss})
+        cpu, peak_rss = process_stats(self.tracker_.pid)
+
+        return {
+            "config": {"seeders": self.num_seeders_, "leechers": self.num_leechers_, "file_size": self.file_size_,
+                       "piece_length": self.piece_length_, "latency": self.latency_, "bandwidth": self.bandwidth_,
+                       "super_seed": self.super_seed_, "interval": self.interval_},
+            "setup_time": setup_time,
+            "time_to_complete": total_time if all(r["completed"] for r in results) else None,
+            "leechers": results,
+            "seeders": seeder_stats,
+            "tracker": {"cpu_seconds": cpu, "peak_rss_kb": peak_rss},
+        }
+
+    async def measure_leecher(self, port, process, directory, start):
+        completed = await self.wait_for_line(process, b"File downloaded", self.timeout_)
+        elapsed = time.monotonic() - start
+        cpu, peak_rss = process_stats(process.pid)
+        verified = False
+        if completed:
+            with open(os.path.join(directory, self.filename_), "rb") as got, \
+                    open(os.path.join(self.workdir_, self.filename_), "rb") as expected:
+                verified = got.read() == expected.read()
+        return {
+            "port": port,
+            "completed": completed,
+            "verified": verified,
+            "time": elapsed if completed else None,
+            "throughput": self.file_size_ / elapsed if completed else None,  # bytes per second
+            "cpu_seconds": cpu,
+            "peak_rss_kb": peak_rss,
+        }
+
+    async def shutdown(self):
+        processes = [p for _, p in self.seeders_] + [p for _, p, _ in self.leechers_]
+        if self.tracker_:
+            processes.append(self.tracker_)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for proxy in self.proxies_:
+            await proxy.stop()
+
+
+async def run_swarm(**kwargs):
+    workdir = tempfile.mkdtemp(prefix="bittorrent-bench-")
+    swarm = Swarm(workdir, **kwargs)
+    try:
+        return await swarm.run()
+    finally:
+        await swarm.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--seeders", type=int, default=1, help="number of seeding clients")
+    parser.add_argument("-l", "--leechers", type=int, default=1, help="number of downloading clients")
+    parser.add_argument("--size", type=int, default=2**22, help="size of the generated file in bytes")
+    parser.add_argument("--piece-length", type=int, default=bencoding.TORRENT_PIECE_LENGTH, help="piece length in bytes")
+    parser.add_argument("--tracker-port", type=int, default=42421, help="port for the tracker")
+    parser.add_argument("--base-port", type=int, default=43000, help="first port given to clients")
+    parser.add_argument("--latency", type=float, default=0.0, help="one way latency in seconds added between peers")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="bytes per second allowed in each direction of a peer connection")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for each leecher")
+    parser.add_argument("--super-seed", action="store_true", help="start the seeders in super-seeding mode")
+    parser.add_argument("--interval", type=int, default=5, help="seconds between tracker requests of the clients")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON report here instead of stdout")
+    parser.add_argument("-d", "--debug", action="store_true", help="show client and tracker output")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_swarm(seeders=args.seeders, leechers=args.leechers, file_size=args.size,
+                                   piece_length=args.piece_length, tracker_port=args.tracker_port,
+                                   base_port=args.base_port, latency=args.latency, bandwidth=args.bandwidth,
+                                   timeout=args.timeout, super_seed=args.super_seed, interval=args.interval,
+                                   debug=args.debug))
+    report["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True,
+                                      text=True).stdout.strip() or None
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -87,9 +87,10 @@ def decode(string):
     return decode_helper(string)[0]
 
 
-def create_torrent_file(filename, *, tracker_url=None, port=42421):
+def create_torrent_file(filename, *, tracker_url=None, port=42421, web_seeds=None):
     # Assumes single file is given and it is in the current directory
     # trackerurl should be "http://ip:port"
+    # web_seeds is a list of urls of HTTP servers that have the file (BEP 19)
     if not tracker_url:
         tracker_url = f"http://{socket.gethostbyname_ex(socket.gethostname())[-1][0]}:{port}"
     d = dict()
@@ -109,6 +110,8 @@ def create_torrent_file(filename, *, tracker_url=None, port=42421):
     info[b"length"] = len(contents)
     d[b"info"] = info
     d[b"announce"] = tracker_url.encode()
+    if web_seeds:
+        d[b"url-list"] = [url.encode() for url in web_seeds]
     with open(f"{filename}.torrent", "wb") as f:
         f.write(encode(d))
     print(f"Created torrent for {filename}.")
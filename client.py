@@ -8,71 +8,221 @@ import aiohttp
 import urllib.parse
 import tempfile
 import math
+import os
+import random
 import socket
 from typing import Union, Optional
 from connection import Connection
+from peers import PeerManager
+import metrics
+import recheck
+import webseed
 
-MAX_PEER_CONNECTIONS = 10
+MAX_PEER_CONNECTIONS = 10  # Downloading connections to start with, and the limit for incoming connections
+MIN_DOWNLOAD_CONNECTIONS = 2
+MAX_DOWNLOAD_CONNECTIONS = 64
+CONNECTION_ADJUST_INTERVAL = 2  # seconds between measuring throughput and resizing the downloading connections
+CONNECTION_STEP = 2  # connections added or removed at a time
+MARGINAL_GAIN = 0.1  # relative throughput change that counts as the last resize having made a difference
+SUPER_SEED_TIMEOUT = 30  # seconds after which a super-seeder reveals a new piece even if the last one didn't spread
 
 
 class Manager:
 
     def __init__(self, piece_length, total_length, output_name,
-                 info_hash, client_id, file_downloaded=False, debug=False):
-        # If file is already downloaded, it is assumed to be in the current directory.
+                 info_hash, client_id, file_downloaded=False, debug=False, metrics=None, have=None, file_path=None,
+                 super_seed=False, piece_hashes=None, web_seeds=None):
+        # If file is already downloaded, it is assumed to be in the current directory unless file_path is given.
+        # have is a bitfield of the pieces that are already in the file (from recheck.recheck_file), when only some are
 
         # File related
         self.bitfield_ = [0] * math.ceil(total_length / piece_length)  # To keep track of which pieces are downloaded
-        self.assigned_ = -1  # Index of the last piece we have given to a connection to download
         self.piece_length_ = piece_length
         self.filename_ = output_name
         self.total_length_ = total_length
+        self.left_ = total_length  # Bytes we don't have yet
         self.info_hash_ = info_hash
+        self.piece_hashes_ = piece_hashes  # info[b"pieces"], to verify downloaded pieces (not verified if None)
 
-        # We will keep downloaded pieces in temporary files during download and upload
-        self.pieces_ = [tempfile.TemporaryFile() for i in range(len(self.bitfield_))]
+        # Pieces we already have are read straight from the file we have them in (self.file_fd_), and only the ones we
+        # download are kept in temporary files, None in self.pieces_ meaning the piece is in the file
         if file_downloaded:
-            with open(output_name, "rb") as file:
-                text = file.read()
-                for i in range(len(self.bitfield_)):
-                    self.pieces_[i].write(text[i*self.piece_length_:(i+1)*self.piece_length_])
-                    self.pieces_[i].seek(0)  # put the stream back at the start to make reading easier
+            have = [1] * len(self.bitfield_)
+        self.file_path_ = None
+        self.file_fd_ = None
+        if have and any(have):
+            self.file_path_ = file_path or output_name
+            self.file_fd_ = os.open(self.file_path_, os.O_RDONLY)
+        self.pieces_ = []
+        for i in range(len(self.bitfield_)):
+            if have and have[i]:
+                self.pieces_.append(None)
+                self.bitfield_[i] = 1
+                self.left_ -= self.piece_size(i)
+            else:
+                self.pieces_.append(tempfile.TemporaryFile())
+        # Pieces we don't have and that no connection is downloading
+        self.unassigned_ = set(i for i in range(len(self.bitfield_)) if not self.bitfield_[i])
+
+        # Super-seeding related: reveal one piece at a time to each peer, and a new one once the last spread
+        self.super_seed_ = super_seed and all(self.bitfield_)
+        self.revealed_ = dict()  # peer_id -> (piece index, time.monotonic()) last revealed to that peer
+        self.revealed_to_ = [set() for i in range(len(self.bitfield_))]  # peer_ids we revealed each piece to
+        self.times_revealed_ = [0] * len(self.bitfield_)
+        self.spread_ = [0] * len(self.bitfield_)  # Whether a peer we didn't reveal the piece to has it
+        self.peer_bitfields_ = dict()  # peer_id -> last bitfield the peer sent us
 
         # Client related
         self.client_id_ = client_id
         self.debug_ = debug
+        self.metrics_ = metrics  # metrics.Metrics, or None if disabled
+        if self.metrics_:
+            self.metrics_.add_collector(self.collect_metrics)
 
         # Download related
         self.downloaded_ = 0
-        # The two below are needed for downloading connections, but to make asyncio work (event loops are weird)
-        # They need to be initialized a bit later
-        if not file_downloaded:
-            self.peers_queue_ = None
-            self.download_connections_ = None
+        # The peer manager is needed for downloading connections, but to make asyncio work (event loops are weird)
+        # it needs to be initialized a bit later
+        self.peers_ = None
+        self.download_tasks_ = set()
+        self.web_seeds_ = web_seeds or []  # URLs of HTTP servers that have the file
+        self.num_download_connections_ = 0
+        self.downloading_ = False  # While Manager.run is downloading, so connections can still be started
+        self.target_connections_ = MAX_PEER_CONNECTIONS
+        self.adjust_direction_ = 1  # Whether we are currently trying more (1) or fewer (-1) connections
+        self.last_rate_ = None  # Download rate measured before the last resize
 
         # Upload related
         self.uploaded_ = 0
         self.num_incoming_connections_ = 0
 
-    def set_queue(self, queue):
-        # asyncio requires the Queue to be created in the function that is called in asyncio.run().
-        # This function transfers that queue to the manager
-        self.peers_queue_ = queue
-        self.download_connections_ = [Connection(self, self.info_hash_, self.client_id_,
-                                                 queue=self.peers_queue_, debug=self.debug_)
-                                      for i in range(MAX_PEER_CONNECTIONS)]
+        self.num_connections_ = 0  # Currently open connections in either direction, for metrics
+
+    def set_peer_manager(self, peers):
+        # asyncio requires the PeerManager to be created in the function that is called in asyncio.run().
+        # This function transfers it to the manager
+        self.peers_ = peers
+
+    def collect_metrics(self, m):
+        # Called when metrics are scraped, so that these don't need to be updated on every change
+        m.set("bittorrent_pieces_unassigned", len(self.unassigned_))
+        m.set("bittorrent_pieces_done", sum(self.bitfield_))
+        m.set("bittorrent_peer_candidates", len(self.peers_.available()) if self.peers_ else 0)
+        m.set("bittorrent_connections", self.num_connections_)
+        m.set("bittorrent_download_connections", self.num_download_connections_)
+        m.set("bittorrent_download_connections_target", self.target_connections_)
+
+    def piece_size(self, index):
+        return min(self.piece_length_, self.total_length_ - index * self.piece_length_)
+
+    def read_piece(self, index):
+        if self.pieces_[index] is None:
+            return os.pread(self.file_fd_, self.piece_size(index), index * self.piece_length_)
+        data = self.pieces_[index].read()
+        self.pieces_[index].seek(0)  # put the stream back at the start to make reading easier
+        return data
 
     def combine_temp_files(self):
+        if self.file_fd_ is not None and os.path.exists(self.filename_) \
+                and os.path.samefile(self.file_path_, self.filename_):
+            # Resuming the file in place, so only the downloaded pieces need to be written
+            if self.debug_:
+                print(f"Writing {sum(p is not None for p in self.pieces_)} pieces into {self.file_path_}")
+            with open(self.filename_, "r+b") as output:
+                for i, temp in enumerate(self.pieces_):
+                    if temp is not None:
+                        output.seek(i * self.piece_length_)
+                        output.write(self.read_piece(i))
+                output.truncate(self.total_length_)
+            return
         with open(self.filename_, "wb") as output:
             if self.debug_:
                 print(f"Combining {len(self.pieces_)} pieces")
-            for temp in self.pieces_:
-                output.write(temp.read())
-                temp.seek(0)
+            for i in range(len(self.pieces_)):
+                output.write(self.read_piece(i))
+
+    def spawn_download_connections(self):
+        # Start connections until we reach the target, but there is no point in having more than the pieces left
+        while self.num_download_connections_ < min(self.target_connections_, len(self.unassigned_)):
+            c = Connection(self, self.info_hash_, self.client_id_, peers=self.peers_, debug=self.debug_,
+                           metrics=self.metrics_)
+            self.num_download_connections_ += 1
+            self.download_tasks_.add(asyncio.create_task(c.run_to_download()))
+
+    def should_retire_connection(self):
+        # Called by downloading connections between pieces, lets them know if we want fewer connections
+        if self.num_download_connections_ > self.target_connections_:
+            self.num_download_connections_ -= 1
+            return True
+        return False
+
+    def connection_finished(self):
+        # Called by downloading connections that stop because there are no pieces left to assign, or are cancelled
+        self.num_download_connections_ -= 1
+
+    def adjust_connections(self, rate):
+        """
+        Hill climbing on the number of downloading connections: keep adding connections while that increases the
+        download rate, and start removing them once it doesn't. If removing connections hurts, go back up.
+        """
+        if self.last_rate_ is not None:
+            if self.adjust_direction_ > 0 and rate < self.last_rate_ * (1 + MARGINAL_GAIN):
+                self.adjust_direction_ = -1
+            elif self.adjust_direction_ < 0 and rate < self.last_rate_ * (1 - MARGINAL_GAIN):
+                self.adjust_direction_ = 1
+        self.last_rate_ = rate
+        self.target_connections_ = min(max(self.target_connections_ + self.adjust_direction_ * CONNECTION_STEP,
+                                           MIN_DOWNLOAD_CONNECTIONS), MAX_DOWNLOAD_CONNECTIONS)
+        if self.debug_:
+            print(f"Manager, rate {rate:.0f} B/s, target connections {self.target_connections_}")
+        self.spawn_download_connections()
+
+    async def tune_connections(self):
+        last_downloaded = self.downloaded_
+        last_time = time.monotonic()
+        while True:
+            await asyncio.sleep(CONNECTION_ADJUST_INTERVAL)
+            now = time.monotonic()
+            self.adjust_connections((self.downloaded_ - last_downloaded) / (now - last_time))
+            last_downloaded = self.downloaded_
+            last_time = now
 
     async def run(self):
         # Download the pieces and combine them
-        await asyncio.gather(*[self.download_connections_[i].run_to_download() for i in range(MAX_PEER_CONNECTIONS)])
+        session = None
+        if self.web_seeds_ and self.unassigned_:
+            session = webseed.create_session()
+            name = self.filename_.decode() if isinstance(self.filename_, bytes) else self.filename_
+            for url in self.web_seeds_:
+                for i in range(webseed.WEB_SEED_CONNECTIONS):
+                    w = webseed.WebSeed(self, webseed.file_url(url, name), session, debug=self.debug_,
+                                        metrics=self.metrics_)
+                    self.download_tasks_.add(asyncio.create_task(w.run()))
+        self.downloading_ = True
+        self.spawn_download_connections()
+        tuner = asyncio.create_task(self.tune_connections())
+        try:
+            while self.download_tasks_ and not all(self.bitfield_):
+                # New connections can be started while we wait, so wait on a copy and check again
+                done, _ = await asyncio.wait(set(self.download_tasks_), return_when=asyncio.FIRST_COMPLETED)
+                self.download_tasks_ -= done
+                for task in done:
+                    task.result()  # Raise exceptions from the connections
+                # Peer connections stop when every piece is assigned, so if a web seed gave up, someone has to take
+                # over its pieces
+                self.spawn_download_connections()
+        finally:
+            self.downloading_ = False
+            tuner.cancel()
+            # Connections still waiting for a peer when the last piece came in (e.g. from a web seed)
+            for task in self.download_tasks_:
+                task.cancel()
+            await asyncio.gather(*self.download_tasks_, return_exceptions=True)  # Let them close their sockets
+            self.download_tasks_.clear()
+            if session:
+                await session.close()
+        if not all(self.bitfield_):
+            raise Exception(f"Download stopped with {self.bitfield_.count(0)} pieces missing")
         if self.debug_:
             print("Manager, combining files")
         self.combine_temp_files()
@@ -80,12 +230,72 @@ class Manager:
             print("Done combining")
         print("File downloaded")
 
-    def get_assignment(self):
-        # tells which block to download (called from Connections)
-        self.assigned_ += 1
-        if self.assigned_ < len(self.bitfield_):
-            return self.assigned_  # string because this will later be converted to bytes
-        return None
+    def pieces_left(self):
+        return len(self.unassigned_)
+
+    def get_assignment(self, peer_pieces):
+        # tells which piece to download among those the peer has (called from Connections)
+        # Picking at random rather than in order makes peers downloading at the same time end up with different pieces,
+        # so they have something to exchange
+        candidates = [i for i in self.unassigned_ if peer_pieces[i]]
+        if not candidates:
+            return None
+        index = random.choice(candidates)
+        self.unassigned_.discard(index)
+        return index
+
+    def return_assignment(self, index):
+        # Called by Connections and web seeds that couldn't download their assignment
+        if not self.bitfield_[index]:
+            self.unassigned_.add(index)
+            if self.downloading_:  # Peer connections may have all stopped, thinking every piece was taken care of
+                self.spawn_download_connections()
+
+    def handle_peer_bitfield(self, peer_id, bitfield):
+        if not self.super_seed_:
+            return
+        self.peer_bitfields_[peer_id] = bitfield
+        for index in range(min(len(bitfield), len(self.bitfield_))):
+            if bitfield[index]:
+                self.saw_piece(peer_id, index)
+
+    def handle_peer_have(self, peer_id, index):
+        if self.super_seed_ and index < len(self.bitfield_):
+            self.saw_piece(peer_id, index)
+
+    def saw_piece(self, peer_id, index):
+        # A peer has the piece. If we didn't give it to them, it is spreading through the swarm
+        if not self.spread_[index] and peer_id not in self.revealed_to_[index]:
+            self.spread_[index] = 1
+            if all(self.spread_):
+                # The swarm has a full copy without us, there is no need to hold back anymore
+                if self.debug_:
+                    print("Manager, every piece has spread, stopping super-seeding")
+                self.super_seed_ = False
+
+    def pieces_to_advertise(self, peer_id):
+        """
+        Returns None if the peer can be told about every piece we have, otherwise the indices to send in have messages.
+        When super-seeding, each peer is shown a single piece, the one revealed the least so far, so that peers get
+        distinct pieces and have to trade them. The peer only gets a new piece once we have seen the last one at a peer
+        we didn't give it to (or after SUPER_SEED_TIMEOUT, in case it has no one to give it to).
+        """
+        if not self.super_seed_:
+            return None
+        now = time.monotonic()
+        if peer_id in self.revealed_:
+            index, revealed_at = self.revealed_[peer_id]
+            if not self.spread_[index] and now - revealed_at < SUPER_SEED_TIMEOUT:
+                return [index]
+        peer_bitfield = self.peer_bitfields_.get(peer_id, [])
+        candidates = [i for i in range(len(self.bitfield_)) if not (i < len(peer_bitfield) and peer_bitfield[i])]
+        if not candidates:
+            return []
+        index = min(candidates, key=lambda i: (self.spread_[i], self.times_revealed_[i], random.random()))
+        self.revealed_[peer_id] = (index, now)
+        self.revealed_to_[index].add(peer_id)
+        self.times_revealed_[index] += 1
+        return [index]
 
     async def handle_incoming_connection(self, reader, writer):
         """
@@ -102,41 +312,73 @@ class Manager:
         else:
             if self.debug_:
                 print("Connection accepted")
-            c = Connection(self, self.info_hash_, self.client_id_, reader=reader, writer=writer, debug=self.debug_)
+            c = Connection(self, self.info_hash_, self.client_id_, reader=reader, writer=writer, debug=self.debug_,
+                           metrics=self.metrics_)
             await c.run_to_upload()
 
     def want_more_peers(self):
-        return not self.peers_queue_.full()
+        return self.peers_.want_more_peers()
 
     def add_peers(self, list_of_peers):
-        # It is possible I will have duplicate peers
-        for peer in list_of_peers:
-            if not self.peers_queue_.full():
-                self.peers_queue_.put_nowait(peer)
+        self.peers_.add_peers(list_of_peers)  # Duplicates are ignored
 
-    def check_for_block(self, payload):  # we are assuming client only uploads when they have the file so this is easy
+    def check_for_block(self, payload, peer_id=None):
         # by assumption, length = piece length
         index = int.from_bytes(payload[0:4], "big")
         begin = int.from_bytes(payload[4:8], "big")
         length = int.from_bytes(payload[8:], "big")
-        data = self.pieces_[index].read()
-        self.pieces_[index].seek(0)
-        self.uploaded_ += length
+        if index >= len(self.bitfield_) or not self.bitfield_[index]:
+            return False, index, None
+        if self.super_seed_ and peer_id not in self.revealed_to_[index]:  # Only serve what we revealed to them
+            return False, index, None
+        if self.metrics_:
+            start = time.perf_counter()
+        data = self.read_piece(index)
+        self.uploaded_ += len(data)  # The last piece is shorter than the requested length
+        if self.metrics_:
+            self.metrics_.observe("bittorrent_disk_seconds", time.perf_counter() - start, op="read")
+            self.metrics_.inc("bittorrent_uploaded_bytes_total", len(data))
         return True, index, data
 
     def handle_received_block(self, payload):
         # by assumption, length = piece length
         index = int.from_bytes(payload[0:4], "big")
         begin = int.from_bytes(payload[4:8], "big")  # in current assumptions, this will always be 0
-        block = payload[8:]
+        return self.store_piece(index, payload[8:])
+
+    def store_piece(self, index, block):
+        # Saves a downloaded piece, from a peer or a web seed. Returns False if it doesn't match the torrent's hash
+        if index >= len(self.bitfield_):
+            return False
+        if self.piece_hashes_ and hashlib.sha1(block).digest() != self.piece_hashes_[index*20:(index+1)*20]:
+            if self.debug_:
+                print(f"Manager, piece {index} failed verification")
+            if self.metrics_:
+                self.metrics_.inc("bittorrent_pieces_rejected_total")
+            return False
+        if self.bitfield_[index]:  # Someone else got it first
+            return True
+        if self.metrics_:
+            start = time.perf_counter()
         self.pieces_[index].write(block)
         self.pieces_[index].seek(0)
+        self.bitfield_[index] = 1
+        self.unassigned_.discard(index)
         self.downloaded_ += len(block)
+        self.left_ -= len(block)
+        if self.metrics_:
+            self.metrics_.observe("bittorrent_disk_seconds", time.perf_counter() - start, op="write")
+            self.metrics_.inc("bittorrent_downloaded_bytes_total", len(block))
+        return True
 
     def close_files(self):
-        # closes the tempfiles used for download
+        # closes the tempfiles used for download, and the file we had pieces in
         for file in self.pieces_:
-            file.close()
+            if file is not None:
+                file.close()
+        if self.file_fd_ is not None:
+            os.close(self.file_fd_)
+            self.file_fd_ = None
 
 
 def extract_response_parameters(response):
@@ -159,8 +401,11 @@ def extract_response_parameters(response):
 
 class Client:
 
-    def __init__(self, torrent_d, ip="", port=42420,  already_has_file=False, debug=False):
+    def __init__(self, torrent_d, ip="", port=42420,  already_has_file=False, debug=False, metrics_port=None,
+                 have=None, file_path=None, super_seed=False, web_seeds=None):
         self.debug_ = debug
+        self.metrics_port_ = metrics_port
+        self.metrics_ = metrics.client_metrics() if metrics_port else None
         # torrent_d is the dictionary created from reading the torrent file
         self.d_: dict[bytes, Union[bytes, int]] = torrent_d
         self.tracker_addr_: str = self.d_[b"announce"].decode()
@@ -180,19 +425,34 @@ class Client:
         self.info_hash_: bytes = m.digest()
 
         # Transfer related info
+        url_list = self.d_.get(b"url-list", [])  # BEP 19 allows a single url or a list of them
+        if isinstance(url_list, bytes):
+            url_list = [url_list]
+        self.web_seeds_: list[str] = [url.decode() for url in url_list if url]
         self.file_done_downloading_: bool = already_has_file
-        self.peer_queue_ = None  # to be handed to self.manager_
+        self.peers_ = None  # to be handed to self.manager_
         self.manager_ = Manager(piece_length=self.d_[b"info"][b"piece length"],
                                 total_length=self.d_[b"info"][b"length"],
                                 output_name=self.d_[b"info"][b"name"],
                                 info_hash=self.info_hash_,
                                 client_id=self.client_id_,
                                 file_downloaded=already_has_file,
-                                debug=debug)
+                                debug=debug,
+                                metrics=self.metrics_,
+                                have=have,
+                                file_path=file_path,
+                                super_seed=super_seed,
+                                piece_hashes=self.d_[b"info"][b"pieces"],
+                                web_seeds=self.web_seeds_ + (web_seeds or []))
 
     async def run(self):
-        self.peer_queue_ = asyncio.Queue(2*MAX_PEER_CONNECTIONS)  # Needs to be created in the function in asyncio.run()
-        self.manager_.set_queue(self.peer_queue_)
+        self.peers_ = PeerManager(debug=self.debug_)  # Needs to be created in the function in asyncio.run()
+        self.manager_.set_peer_manager(self.peers_)
+        if self.metrics_:
+            await self.metrics_.serve(self.ip_, self.metrics_port_)
+
+        # Serve the pieces we have to other peers while we download the rest
+        server = await asyncio.start_server(self.handle_connection, self.ip_, self.port_)
 
         response = await self.send_tracker_request("started")  # Let server register us
         if self.debug_:
@@ -205,27 +465,32 @@ class Client:
             self.manager_.add_peers(response["peers"])
             if self.debug_:
                 print("Client running the manager")
-            await self.manager_.run()
+            # Fetch more peers from the tracker while the manager downloads
+            fetcher = asyncio.create_task(self.fetch_more_peers())
+            try:
+                await self.manager_.run()
+            finally:
+                fetcher.cancel()
             self.file_done_downloading_ = True
 
-        # Loop during download to fetch more peers
-        # TODO I suspect this part might not be working as intended, it just stops at the await above
-        # Potential solution is to prompt client to request more peers from the manager when needed
-        while not self.file_done_downloading_:
-            # Sleep first to avoid contacting tracker immediately after the previous one
-            await asyncio.sleep(self.interval_)
-            if self.manager_.want_more_peers():
-                response = await self.send_tracker_request()
-                self.manager_.add_peers(response["peers"])
-
         # Either we already have file or we finished downloading
-        # So change into serving other requesters
+        # So keep serving other requesters
         await self.send_tracker_request("completed")  # We don't care about what server might tell us at this point
-        server = await asyncio.start_server(self.handle_connection, self.ip_, self.port_)
 
         async with server:
             await server.serve_forever()
 
+    async def fetch_more_peers(self):
+        while not self.file_done_downloading_:
+            # Sleep first to avoid contacting tracker immediately after the previous one
+            await asyncio.sleep(self.interval_)
+            if self.manager_.want_more_peers():
+                try:
+                    response = await self.send_tracker_request()
+                except aiohttp.ClientError:
+                    continue  # The tracker might be back by the next interval
+                self.manager_.add_peers(response["peers"])
+
     async def handle_connection(self, reader, writer):
         # For handling requests from other peers
         if self.debug_:
@@ -245,7 +510,7 @@ class Client:
             'port': self.port_,
             'uploaded': self.manager_.uploaded_,
             'downloaded': self.manager_.downloaded_,
-            'left': self.manager_.total_length_ - self.manager_.downloaded_,
+            'left': self.manager_.left_,
             'compact': 1,
             'event': event
         }
@@ -277,14 +542,40 @@ if __name__ == "__main__":
                         help="ip address for client (by default inferred from socket.gethostbyname_ex())")
     parser.add_argument("-p", "--port", type=int, default=42420, help="port for client")
     parser.add_argument("-d", "--debug", action="store_true", help="print debug message")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics at /metrics on this port (disabled by default)")
+    parser.add_argument("-w", "--web-seed", action="append", default=[],
+                        help="url of an HTTP server with the file, in addition to those in the torrent (repeatable)")
+    parser.add_argument("--super-seed", action="store_true",
+                        help="when seeding a new torrent, reveal pieces one at a time so that peers trade them")
+    parser.add_argument("--recheck", action="store_true",
+                        help="verify the file (given with -f, or named as in the torrent) against the torrent "
+                             "and only download the pieces that don't match")
     args = parser.parse_args()
     with open(args.torrent_file, "rb") as f:
         torrent_d = bencoding.decode(f.read())
-    if args.file:
-        # TODO check if given torrent file matches the file (look at the hash?)
-        client = Client(torrent_d, args.ip, args.port, already_has_file=True, debug=args.debug)
+    if args.recheck:
+        path = args.file or torrent_d[b"info"][b"name"].decode()
+
+        last_printed = [0]  # Last 5% step printed, checked can go past several steps at once
+
+        def print_progress(checked, total):
+            step = checked * 20 // max(total, 1)
+            if step > last_printed[0]:
+                last_printed[0] = step
+                print(f"Rechecked {checked}/{total} pieces")
+
+        have = recheck.recheck_file(path, torrent_d[b"info"], progress=print_progress)
+        print(f"{sum(have)}/{len(have)} pieces of {path} match the torrent")
+        client = Client(torrent_d, args.ip, args.port, already_has_file=all(have), debug=args.debug,
+                        metrics_port=args.metrics_port, have=have, file_path=path, super_seed=args.super_seed,
+                        web_seeds=args.web_seed)
+    elif args.file:
+        client = Client(torrent_d, args.ip, args.port, already_has_file=True, debug=args.debug,
+                        metrics_port=args.metrics_port, file_path=args.file, super_seed=args.super_seed)
     else:
-        client = Client(torrent_d, args.ip, args.port, already_has_file=False, debug=args.debug)
+        client = Client(torrent_d, args.ip, args.port, already_has_file=False, debug=args.debug,
+                        metrics_port=args.metrics_port, web_seeds=args.web_seed)
 
     try:
         print("Client starting.")
@@ -1,4 +1,8 @@
 import asyncio
+import time
+
+HANDSHAKE_TIMEOUT = 10  # seconds to wait for the peer's handshake
+MESSAGE_TIMEOUT = 30  # seconds to wait for the next message while downloading, before trying another peer
 
 
 ETB = (23).to_bytes(1, "big")  # End of transmission block character used to mark read/write blocks for asyncio
@@ -7,12 +11,13 @@ DEBUG_ID = 0  # To differentiate between connections when debugging, each gets a
 
 class Connection:
 
-    def __init__(self, manager, info_hash, client_id, debug=False, *, queue=None, reader=None, writer=None):
+    def __init__(self, manager, info_hash, client_id, debug=False, *, peers=None, reader=None, writer=None,
+                 metrics=None):
         # I thought `None or None` would be False, but it is empty, so this is a workaround
-        if queue and not not (reader or writer):
-            raise Exception("Connections should either be initialized with a peer queue (to download) "
+        if peers and not not (reader or writer):
+            raise Exception("Connections should either be initialized with a peer manager (to download) "
                             "or reader and writer (to upload).")
-        if queue:  # outgoing connection
+        if peers:  # outgoing connection
             self.type_ = "outgoing"
         else:
             self.type_ = "incoming"
@@ -20,12 +25,24 @@ class Connection:
         self.info_hash_ = info_hash
         self.client_id_ = client_id.encode()  # I don't think we ever need this as a string
         self.manager_ = manager
-        self.peer_queue_ = queue
+        self.peers_ = peers  # peers.PeerManager
+        self.peer_ = None  # (ip, port) of the peer we are downloading from
+        self.peer_pieces_ = None  # Pieces self.peer_ told us it has, as 0/1 like Manager.bitfield_
+        self.piece_started_at_ = None  # When we connected to self.peer_, to score it
         self.reader_ = reader
         self.writer_ = writer
         self.peer_id_ = None
         self.debug_ = debug
 
+        # Metrics related, only used if metrics is not None
+        self.metrics_ = metrics
+        self.peer_label_ = None  # ip of the peer, incoming connections come from a new port every time
+        self.connection_label_ = None  # "local port-ip:port", for series that are removed when the connection closes
+        self.connected_at_ = None
+        self.bytes_in_ = 0
+        self.bytes_out_ = 0
+        self.request_sent_at_ = None
+
         # Download related
         self.active_ = False
         self.assignment_ = None
@@ -37,12 +54,17 @@ class Connection:
         self.remote_interested_ = False
         self.can_send_ = False
 
+    async def read_handshake(self):
+        # The info hash can contain ETB, so read the fixed length part first. The peer id is made of digits.
+        start = await self.reader_.readexactly(49)
+        peer_id = await self.reader_.readuntil(ETB)
+        return start + peer_id[:-1]  # get rid of extra ETB
+
     async def initiate_handshake(self):
         # For downloading connections
         self.writer_.write(b"19BitTorrent protocol00000000" + self.info_hash_ + self.client_id_ + ETB)
         await self.writer_.drain()
-        recv_handshake = await self.reader_.readuntil(ETB)  # read the length of a handshake
-        recv_handshake = recv_handshake[:-1]  # get rid of extra ETB
+        recv_handshake = await self.read_handshake()
         if recv_handshake[:29] == b"19BitTorrent protocol00000000" and recv_handshake[29:49] == self.info_hash_:
             if not self.peer_id_:
                 self.peer_id_ = recv_handshake[49:]
@@ -52,8 +74,7 @@ class Connection:
 
     async def expect_handshake(self):
         # For uploading connections
-        recv_handshake = await self.reader_.readuntil(ETB)  # read the length of a handshake
-        recv_handshake = recv_handshake[:-1]  # get rid of extra ETB
+        recv_handshake = await self.read_handshake()
         if recv_handshake[:29] == b"19BitTorrent protocol00000000" and recv_handshake[29:49] == self.info_hash_:
             if not self.peer_id_:
                 self.peer_id_ = recv_handshake[49:]
@@ -67,48 +88,103 @@ class Connection:
 
     async def send_message(self, message, data=None):
         # for request, should figure it out from self.assignment_
+        msg = b""
         if message == "keep alive":
-            self.writer_.write((0).to_bytes(4, "big"))  # gives <0000>
+            msg = (0).to_bytes(4, "big")  # gives <0000>
 
         elif message == "choke":
-            self.writer_.write((256).to_bytes(5, "big"))  # gives <0001><0>
+            msg = (256).to_bytes(5, "big")  # gives <0001><0>
 
         elif message == "unchoke":
-            self.writer_.write((257).to_bytes(5, "big"))  # gives <0001><1>
+            msg = (257).to_bytes(5, "big")  # gives <0001><1>
 
         elif message == "interested":
-            self.writer_.write((258).to_bytes(5, "big"))  # gives <0001><2>
+            msg = (258).to_bytes(5, "big")  # gives <0001><2>
 
         elif message == "not interested":
-            self.writer_.write((259).to_bytes(5, "big"))  # gives <0001><3>
+            msg = (259).to_bytes(5, "big")  # gives <0001><3>
 
         elif message == "have":
-            raise Exception("Not Implemented")  # Because uploaders are assumed to have the whole file
+            # data should be the index of the piece we have
+            msg = (5).to_bytes(4, "big") + (4).to_bytes(1, "big") + data.to_bytes(4, "big")  # <0005><4><index>
 
         elif message == "bitfield":
-            raise Exception("Not Implemented")  # Because uploaders are assumed to have the whole file
+            # data should be a list of 0/1 like Manager.bitfield_, sent as a bytestring of b"0"/b"1" (see receive)
+            bits = bytes(b"1"[0] if bit else b"0"[0] for bit in data)
+            msg = (1+len(bits)).to_bytes(4, "big") + (5).to_bytes(1, "big") + bits
 
         elif message == "request":
             prefix = (13).to_bytes(4, "big") + (6).to_bytes(1, "big")  # length prefix + id <0013><6>
             index = self.assignment_.to_bytes(4, "big")  # the index of the piece to download
             begin = (0).to_bytes(4, "big")  # by assumption, we download the entire piece
             length = self.manager_.piece_length_.to_bytes(4, "big")
-            self.writer_.write(prefix+index+begin+length)
+            msg = prefix+index+begin+length
 
         elif message == "piece":
             # if piece message is given, data should be a bytestring
             prefix = (9+len(data)).to_bytes(4, "big") + (7).to_bytes(1, "big")  # length prefix + id
             index = self.assignment_.to_bytes(4, "big")  # the index of the piece to download
             begin = (0).to_bytes(4, "big")  # by assumption, we download the entire piece
-            self.writer_.write(prefix+index+begin+data)
+            msg = prefix+index+begin+data
 
         elif message == "cancel":  # Right now this doesn't matter because we assume uploaders have entire file
             pass
-        self.writer_.write(ETB)  # need to end message with etb so reading will work properly
+        self.writer_.write(msg + ETB)  # need to end message with etb so reading will work properly
         await self.writer_.drain()
+        if self.metrics_:
+            self.record_bytes("out", len(msg) + 1)
+            if message == "request":
+                self.request_sent_at_ = time.perf_counter()
+            elif message in ("choke", "unchoke"):
+                self.record_choke(message == "choke")
+
+    def connection_opened(self):
+        if self.writer_:
+            peer = self.writer_.get_extra_info("peername")
+            local = self.writer_.get_extra_info("sockname")
+            if peer:
+                self.peer_label_ = peer[0]
+                # Several outgoing connections can go to the same peer at once, but each has its own local port
+                self.connection_label_ = f"{local[1] if local else ''}-{peer[0]}:{peer[1]}"
+        self.connected_at_ = time.monotonic()
+        self.bytes_in_ = 0
+        self.bytes_out_ = 0
+        self.manager_.num_connections_ += 1
+        self.record_choke(self.being_choked_ if self.type_ == "outgoing" else self.choking_)
+
+    def connection_closed(self):
+        if self.connected_at_ is None:  # Already recorded
+            return
+        self.connected_at_ = None
+        self.manager_.num_connections_ -= 1
+        for direction in ("in", "out"):
+            self.metrics_.remove("bittorrent_peer_rate_bytes", connection=self.connection_label_, direction=direction)
+        self.metrics_.remove("bittorrent_peer_choked", connection=self.connection_label_, type=self.type_)
+
+    def record_bytes(self, direction, n):
+        if direction == "in":
+            self.bytes_in_ += n
+            total = self.bytes_in_
+        else:
+            self.bytes_out_ += n
+            total = self.bytes_out_
+        self.metrics_.inc("bittorrent_peer_bytes_total", n, peer=self.peer_label_, direction=direction)
+        if self.connected_at_ is None:
+            return
+        elapsed = time.monotonic() - self.connected_at_
+        if elapsed > 0:
+            self.metrics_.set("bittorrent_peer_rate_bytes", total / elapsed, connection=self.connection_label_,
+                              direction=direction)
+
+    def record_choke(self, choked):
+        self.metrics_.set("bittorrent_peer_choked", int(choked), connection=self.connection_label_, type=self.type_)
 
     async def receive_message(self):
-        message = await self.reader_.readuntil(ETB)
+        # Pieces and indices can contain ETB, so use the length prefix to know where the message ends
+        prefix = await self.reader_.readexactly(4)
+        message = prefix + await self.reader_.readexactly(int.from_bytes(prefix, "big") + 1)  # +1 for the ETB
+        if self.metrics_:
+            self.record_bytes("in", len(message))
         length = int.from_bytes(message[:4], "big")
         id = int.from_bytes(message[4:5], "big")
         payload = message[5:][:-1]  # second slice is to get rid of '\n' added by sender
@@ -128,6 +204,7 @@ class Connection:
             op = "not interested"
         elif id == 4:
             op = "have"
+            payload = int.from_bytes(payload, "big")
         elif id == 5:
             # There is likely a better way to write this using int.from_bytes, but since I am not using it yet, I won't
             op = "bitfield"
@@ -145,14 +222,32 @@ class Connection:
         return op, payload
 
     async def run_to_download(self):
-        global DEBUG_ID
         """
         Outgoing connection to download.
-        First, get an assignment from manager to figure out what data to request
-        Then, get a peer from the queue and establish connection/handshake.
-        If successful, let them know we are interested and wait until unchoked.
-        Then request the data, give it to manager when received
+        First, get a connected peer from the peer manager and handshake.
+        If successful, tell them which pieces we have, let them know we are interested and wait until unchoked.
+        The peer tells us which pieces it has (with a bitfield or have messages) before unchoking us.
+        Then get an assignment among those pieces from the manager, request it, and give it to manager when received.
+        If the peer fails or stops answering, give the assignment back and try another peer.
         """
+        try:
+            await self.download()
+        except asyncio.CancelledError:
+            # The manager cancels the connections left once every piece is in, maybe in the middle of a handshake
+            if self.active_:
+                self.active_ = False
+                if self.assignment_ is not None:
+                    self.manager_.return_assignment(self.assignment_)
+                    self.assignment_ = None
+                self.peers_.release(self.peer_)
+                self.writer_.close()
+                if self.metrics_:
+                    self.connection_closed()
+            self.manager_.connection_finished()
+            raise
+
+    async def download(self):
+        global DEBUG_ID
         debug_id = DEBUG_ID
         DEBUG_ID += 1
         if self.debug_:
@@ -169,69 +264,80 @@ class Connection:
                 if self.debug_:
                     print(f"{debug_id}: not active")
 
-                if not self.assignment_:  # If we don't have a piece assigned to download, get one
-                    self.assignment_ = self.manager_.get_assignment()
-                    if self.debug_:
-                        print(f"{debug_id}: Received assignment {self.assignment_}")
-
-                if self.assignment_ is not None:  # If we know what to download, but don't yet have an active connection
-                    if self.debug_:
-                        print(f"{debug_id}: Assignment is not None")
-
-                    self.active_ = True
-                    peer_ip, peer_port = await self.peer_queue_.get()  # get peer to connect to
+                if not self.manager_.pieces_left():  # The other connections have the remaining pieces, we are done
                     if self.debug_:
-                        print(f"{debug_id}: About to open connection")
-
-                    self.reader_, self.writer_ = await asyncio.open_connection(peer_ip, peer_port)
+                        print(f"{debug_id}: No pieces left to assign, closing")
+                    self.manager_.connection_finished()
+                    return
+                if self.manager_.should_retire_connection():
                     if self.debug_:
-                        print(f"{debug_id}: Send connection command")
+                        print(f"{debug_id}: Manager wants fewer connections, closing")
+                    return
 
-                    shook_hands = await self.initiate_handshake()
+                if self.debug_:
+                    print(f"{debug_id}: About to open connection")
+                self.peer_, self.reader_, self.writer_ = await self.peers_.connect()
+                self.active_ = True
+                self.peer_id_ = None  # We may have talked to another peer before
+                self.peer_pieces_ = [0] * len(self.manager_.bitfield_)
+                self.piece_started_at_ = time.monotonic()
+                if self.metrics_:
+                    self.connection_opened()
+                if self.debug_:
+                    print(f"{debug_id}: Send connection command")
 
-                    if not shook_hands:  # If we had a problem establishing connection, move onto next peer
-                        if self.debug_:
-                            print(f"{debug_id}: Handshake failed")
-                        self.active_ = False
-                        self.writer_.close()
-                        await self.writer_.wait_closed()
-                        continue
+                try:
+                    shook_hands = await asyncio.wait_for(self.initiate_handshake(), HANDSHAKE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    shook_hands = False
 
+                if not shook_hands:  # If we had a problem establishing connection, move onto next peer
                     if self.debug_:
-                        print(f"{debug_id}: Shook hands")
-                        print(f"{debug_id}: Sending interested message")
-                    self.being_choked_ = True
-                    self.interested_ = False
-                    await self.send_message("interested")
-                    if self.debug_:
-                        print(f"{debug_id}: Sent interested message")
+                        print(f"{debug_id}: Handshake failed")
+                    await self.drop_peer()
+                    continue
 
-                else:  # The other connections will download all remaining pieces, so we are done here.
-                    if self.debug_:
-                        print(f"{debug_id}: Assignment is None, closing")
-                    if self.writer_:
-                        self.writer_.close()
-                        if self.debug_:
-                            print(f"{debug_id}: About to close")
-                        await self.writer_.wait_closed()
-                        if self.debug_:
-                            print(f"{debug_id}: Closed")
-                        self.peer_queue_.put_nowait((peer_ip, peer_port))
-                        # This peer is usable by other connections, but this way also means if a file has more than
-                        # client.MAX_PEER_CONNECTIONS pieces, it won't be downloaded in full
-                    return
+                if self.debug_:
+                    print(f"{debug_id}: Shook hands")
+                    print(f"{debug_id}: Sending bitfield and interested message")
+                self.being_choked_ = True
+                self.interested_ = False
+                try:
+                    await self.send_message("bitfield", self.manager_.bitfield_)
+                    await self.send_message("interested")
+                except ConnectionError:
+                    await self.drop_peer()
+                    continue
+                if self.debug_:
+                    print(f"{debug_id}: Sent interested message")
 
-            if not self.being_choked_:
+            if not self.being_choked_ and self.assignment_ is None:
                 if self.debug_:
                     print(f"{debug_id}: Unchoked")
-                await self.send_message("request")
+                self.assignment_ = self.manager_.get_assignment(self.peer_pieces_)
+                if self.debug_:
+                    print(f"{debug_id}: Received assignment {self.assignment_}")
+                if self.assignment_ is None:  # The peer has nothing we need right now
+                    self.active_ = False
+                    self.peers_.unhelpful(self.peer_)
+                    await self.close_writer()
+                    continue
+                try:
+                    await self.send_message("request")
+                except ConnectionError:
+                    await self.drop_peer()
+                    continue
 
             if self.debug_:
                 print(f"{debug_id}: Waiting for unchoke or other message message")
             try:
-                message, payload = await self.receive_message()
-            except asyncio.IncompleteReadError:
-                message = None
+                message, payload = await asyncio.wait_for(self.receive_message(), MESSAGE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                # The peer went away or stopped answering, give the assignment back and try someone else
+                if self.debug_:
+                    print(f"{debug_id}: Lost peer {self.peer_}")
+                await self.drop_peer()
+                continue
 
             if message == "keep alive":  # Right now this doesn't matter because we assume little waiting time
                 pass
@@ -239,18 +345,23 @@ class Connection:
                 if self.debug_:
                     print(f"{debug_id}: received choke")
                 self.being_choked_ = True
+                if self.metrics_:
+                    self.record_choke(True)
             elif message == "unchoke":
                 if self.debug_:
                     print(f"{debug_id}: received unchoke")
                 self.being_choked_ = False
+                if self.metrics_:
+                    self.record_choke(False)
             elif message == "interested":  # Right now this doesn't matter because we are downloading only
                 pass
             elif message == "not interested":  # Right now this doesn't matter because we are downloading only
                 pass
-            elif message == "have":  # Right now this doesn't matter because we assume uploaders have entire file
-                pass
-            elif message == "bitfield":  # Right now this doesn't matter because we assume uploaders have entire file
-                pass
+            elif message == "have":
+                if payload < len(self.peer_pieces_):
+                    self.peer_pieces_[payload] = 1
+            elif message == "bitfield":
+                self.peer_pieces_ = (payload + [0] * len(self.peer_pieces_))[:len(self.peer_pieces_)]
             elif message == "request":  # This shouldn't happen as this connection will only be for download
                 "Send error message?"
                 pass
@@ -258,12 +369,41 @@ class Connection:
                 # Since we are downloading one piece at a time instead of dividing to blocks, this is simpler
                 if self.debug_:
                     print(f"{debug_id}: received piece")
-                self.manager_.handle_received_block(payload)
+                if self.metrics_ and self.request_sent_at_ is not None:
+                    self.metrics_.observe("bittorrent_request_seconds", time.perf_counter() - self.request_sent_at_)
+                    self.request_sent_at_ = None
+                if int.from_bytes(payload[0:4], "big") != self.assignment_ \
+                        or not self.manager_.handle_received_block(payload):
+                    if self.debug_:
+                        print(f"{debug_id}: received wrong or corrupt piece")
+                    await self.drop_peer()
+                    continue
+                self.peers_.release(self.peer_, len(payload) - 8, time.monotonic() - self.piece_started_at_)
                 self.active_ = False
                 self.assignment_ = None
+                # Uploaders send one piece per connection, so we move onto another connection for the next piece
+                await self.close_writer()
             elif message == "cancel":  # Right now this doesn't matter because we assume uploaders have entire file
                 pass
 
+    async def close_writer(self):
+        self.writer_.close()
+        try:
+            await self.writer_.wait_closed()
+        except ConnectionError:
+            pass
+        if self.metrics_:
+            self.connection_closed()
+
+    async def drop_peer(self):
+        # Give up on the current peer, and let another connection download our assignment
+        self.active_ = False
+        if self.assignment_ is not None:
+            self.manager_.return_assignment(self.assignment_)
+            self.assignment_ = None
+        self.peers_.failed(self.peer_)
+        await self.close_writer()
+
     async def run_to_upload(self):
         global DEBUG_ID
         debug_id = DEBUG_ID
@@ -277,31 +417,56 @@ class Connection:
 
         if self.debug_:
             print(f"{debug_id}: Expecting handshake")
-        shook_hands = await self.expect_handshake()
+        try:
+            shook_hands = await asyncio.wait_for(self.expect_handshake(), HANDSHAKE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            shook_hands = False  # Downloaders dial several peers at once and hang up on the ones they don't need
         if not shook_hands:  # If we had a problem establishing connection, give up
             if self.debug_:
                 print(f"{debug_id}: Problem in handshake")
+            self.writer_.close()
             return
         if self.debug_:
             print(f"{debug_id}: Shook hands")
         self.choking_ = True
         self.remote_interested_ = False
+        if self.metrics_:
+            self.connection_opened()
         while True:
             try:
                 message, payload = await self.receive_message()
                 if self.debug_:
                     print(f"{debug_id}: Received message")
                     print(f"{debug_id}: message: {message}")
-            except asyncio.IncompleteReadError:
-                message = None
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # The downloader hung up, possibly after giving up on us
+                if self.debug_:
+                    print(f"{debug_id}: Peer closed the connection")
+                await self.close_writer()
+                return
 
             if not self.remote_interested_ and message == "interested":  # The first message we expect is interested
                 if self.debug_:
                     print(f"{debug_id}: Setting interested to True")
                 self.remote_interested_ = True
-                if self.debug_:
-                    print(f"{debug_id}: Sending unchoke")
-                await self.send_message("unchoke")
+                # Tell them which pieces they can ask for before unchoking, since that is when they pick one
+                advertised = self.manager_.pieces_to_advertise(self.peer_id_)
+                try:
+                    if advertised is None:
+                        await self.send_message("bitfield", self.manager_.bitfield_)
+                    else:  # Super-seeding, only reveal some pieces
+                        if self.debug_:
+                            print(f"{debug_id}: Revealing pieces {advertised}")
+                        for index in advertised:
+                            await self.send_message("have", index)
+                    if self.debug_:
+                        print(f"{debug_id}: Sending unchoke")
+                    await self.send_message("unchoke")
+                except ConnectionError:
+                    if self.debug_:
+                        print(f"{debug_id}: Peer closed the connection")
+                    await self.close_writer()
+                    return
                 self.choking_ = False
 
             elif message == "keep alive":  # Right now this doesn't matter because we assume little waiting time
@@ -314,10 +479,10 @@ class Connection:
                 if self.debug_:
                     print(f"{debug_id}: received not interested")
                 self.remote_interested_ = False
-            elif message == "have":  # Doesn't matter, we are uploading
-                pass
-            elif message == "bitfield":  # Doesn't matter, we are uploading
-                pass
+            elif message == "have":
+                self.manager_.handle_peer_have(self.peer_id_, payload)
+            elif message == "bitfield":  # Downloaders tell us what they have, super-seeding uses it
+                self.manager_.handle_peer_bitfield(self.peer_id_, payload)
             elif message == "request":
                 if self.debug_:
                     print(f"{debug_id}: received request")
@@ -325,18 +490,31 @@ class Connection:
                     if self.debug_:
                         print(f"{debug_id}: request ignored due to choking")
                     continue
-                can_send, index, data = self.manager_.check_for_block(payload)
-                if can_send:
+                can_send, index, data = self.manager_.check_for_block(payload, self.peer_id_)
+                if not can_send:  # We don't have it or didn't offer it, hang up so they try someone else quickly
                     if self.debug_:
-                        print(f"{debug_id}: request sending")
-                    self.can_send_ = True
-                    self.assignment_ = index  # Sending piece message uses it
+                        print(f"{debug_id}: can't send piece {index}")
+                    await self.close_writer()
+                    return
+                if self.debug_:
+                    print(f"{debug_id}: request sending")
+                self.can_send_ = True
+                self.assignment_ = index  # Sending piece message uses it
+                try:
                     await self.send_message("piece", data)
-                    self.assignment_ = None
-                    self.can_send_ = False
+                except ConnectionError:  # The downloader gave up on us while we were sending
                     if self.debug_:
-                        print(f"{debug_id}: Ending run_to_upload")
+                        print(f"{debug_id}: Peer closed the connection while sending piece {index}")
+                    await self.close_writer()
                     return
+                finally:
+                    self.assignment_ = None
+                    self.can_send_ = False
+                if self.debug_:
+                    print(f"{debug_id}: Ending run_to_upload")
+                if self.metrics_:
+                    self.connection_closed()
+                return
             elif message == "piece":  # Doesn't matter, we are uploading
                 pass
             elif message == "cancel":
@@ -0,0 +1,132 @@
+# Metrics collection and Prometheus text format exposition for clients and the tracker
+import bisect
+import time
+from aiohttp import web
+
+# Upper bounds (in seconds) of histogram buckets, fine enough for both disk writes and round trips over the internet
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsError(Exception):
+    pass
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(val).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, val in labels)
+    return "{" + ",".join(f'{key}="{val}"' for (key, _), val in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    """
+    A small registry of counters, gauges and histograms.
+    Nothing here is thread safe, it is meant to be used from a single event loop.
+    Components keep a reference that is None when metrics are disabled and check it before recording anything,
+    so disabled metrics cost a single attribute check.
+    """
+
+    def __init__(self):
+        self.kinds_ = dict()  # name -> "counter", "gauge" or "histogram"
+        self.help_ = dict()  # name -> description
+        self.values_ = dict()  # name -> {labels: value} (for histograms value is [bucket counts, sum, count])
+        self.collectors_ = []  # Functions called before rendering, to update gauges that are cheaper to read on demand
+        self.start_time_ = time.monotonic()
+
+    def describe(self, name, kind, help_text):
+        if kind not in ("counter", "gauge", "histogram"):
+            raise MetricsError(f"Unknown metric type: {kind}")
+        self.kinds_[name] = kind
+        self.help_[name] = help_text
+        self.values_.setdefault(name, dict())
+
+    def add_collector(self, collector):
+        self.collectors_.append(collector)
+
+    def inc(self, name, value=1, **labels):
+        series = self.values_[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values_[name][tuple(sorted(labels.items()))] = value
+
+    def remove(self, name, **labels):
+        self.values_[name].pop(tuple(sorted(labels.items())), None)
+
+    def observe(self, name, value, **labels):
+        series = self.values_[name]
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+        buckets, total, count = series[key]
+        i = bisect.bisect_left(DEFAULT_BUCKETS, value)
+        if i < len(buckets):
+            buckets[i] += 1
+        series[key][1] = total + value
+        series[key][2] = count + 1
+
+    def render(self):
+        for collector in self.collectors_:
+            collector(self)
+        lines = []
+        for name, kind in self.kinds_.items():
+            lines.append(f"# HELP {name} {self.help_[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in self.values_[name].items():
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(key)} {value}")
+                    continue
+                buckets, total, count = value
+                cumulative = 0
+                for bound, n in zip(DEFAULT_BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_labels(key)} {total}")
+                lines.append(f"{name}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def handler(self, request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
+
+    async def serve(self, host, port):
+        # Starts a separate HTTP server for /metrics, returns the runner so it can be cleaned up
+        app = web.Application()
+        app.add_routes([web.get("/metrics", self.handler)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def client_metrics():
+    m = Metrics()
+    m.describe("bittorrent_peer_bytes_total", "counter", "Bytes exchanged with a peer ip, including headers")
+    m.describe("bittorrent_peer_rate_bytes", "gauge", "Average bytes per second over an open connection")
+    m.describe("bittorrent_peer_choked", "gauge", "1 if the connection is choked (being choked when downloading, "
+                                                  "choking when uploading)")
+    m.describe("bittorrent_request_seconds", "histogram", "Time between sending a request and receiving the piece")
+    m.describe("bittorrent_disk_seconds", "histogram", "Time spent reading or writing pieces")
+    m.describe("bittorrent_pieces_unassigned", "gauge", "Pieces not yet given to a connection to download")
+    m.describe("bittorrent_pieces_done", "gauge", "Pieces downloaded or already present")
+    m.describe("bittorrent_peer_candidates", "gauge", "Known peers that can be dialed right now")
+    m.describe("bittorrent_connections", "gauge", "Open connections to peers")
+    m.describe("bittorrent_download_connections", "gauge", "Downloading connections running")
+    m.describe("bittorrent_download_connections_target", "gauge", "Downloading connections the manager aims for")
+    m.describe("bittorrent_uploaded_bytes_total", "counter", "Bytes of pieces uploaded")
+    m.describe("bittorrent_downloaded_bytes_total", "counter", "Bytes of pieces downloaded")
+    m.describe("bittorrent_pieces_rejected_total", "counter", "Downloaded pieces that didn't match the torrent's hash")
+    m.describe("bittorrent_webseed_bytes_total", "counter", "Bytes downloaded from a web seed")
+    m.describe("bittorrent_webseed_request_seconds", "histogram", "Time taken by a range request to a web seed")
+    return m
+
+
+def tracker_metrics():
+    m = Metrics()
+    m.describe("bittorrent_tracker_announces_total", "counter", "Announce requests received, by event")
+    m.describe("bittorrent_tracker_request_seconds", "histogram", "Time spent handling an announce")
+    m.describe("bittorrent_tracker_peers", "gauge", "Peers known to the tracker")
+    m.describe("bittorrent_tracker_seeders", "gauge", "Peers that reported completing the download")
+    return m
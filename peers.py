@@ -0,0 +1,152 @@
+# Keeps track of peers we can download from, dials them and scores them
+import asyncio
+import time
+
+CONNECT_TIMEOUT = 5  # seconds to wait for a TCP connection before giving up on a peer
+DIAL_PARALLELISM = 3  # candidates dialed at once, the first one to answer is used
+MAX_CONNECTIONS_PER_PEER = 4  # uploaders only send one piece per connection, so we open several to the same peer
+MAX_PEER_FAILURES = 5  # consecutive failures after which a peer is forgotten (until the tracker gives it again)
+BACKOFF_BASE = 1  # seconds, doubled after every consecutive failure
+RATE_SMOOTHING = 0.3  # weight of the latest measurement in a peer's throughput estimate
+WANTED_CANDIDATES = 20  # ask the tracker for more peers when fewer than this many are usable
+
+
+class PeerInfo:
+
+    def __init__(self, address):
+        self.address_ = address  # (ip, port) pair
+        self.rate_ = None  # estimated bytes per second, None if we never downloaded from this peer
+        self.failures_ = 0  # consecutive failures
+        self.retry_at_ = 0  # time.monotonic() before which we shouldn't dial again
+        self.in_use_ = 0  # connections being dialed or open to this peer
+
+    def score(self):
+        # Untried peers come first so that we learn about them, then the fastest ones relative to how busy they are
+        if self.rate_ is None:
+            return float("inf")
+        return self.rate_ / (1 + self.in_use_) / (1 + self.failures_)
+
+
+class PeerManager:
+    """
+    Replaces a plain queue of (ip, port) pairs for downloading connections.
+    Peers are deduplicated, dialed several at a time with a timeout, and ranked by the throughput we observed from
+    them. Failing peers are retried with exponential backoff and eventually dropped.
+    """
+
+    def __init__(self, debug=False):
+        # Like asyncio.Queue, this has to be created inside the function given to asyncio.run()
+        self.peers_ = dict()  # (ip, port) -> PeerInfo
+        self.changed_ = asyncio.Event()  # Set when a peer might have become available
+        self.debug_ = debug
+
+    def add_peers(self, list_of_peers):
+        for address in list_of_peers:
+            address = (address[0], int(address[1]))
+            if address not in self.peers_:
+                self.peers_[address] = PeerInfo(address)
+                self.changed_.set()
+
+    def available(self, now=None):
+        now = now or time.monotonic()
+        return [p for p in self.peers_.values() if p.in_use_ < MAX_CONNECTIONS_PER_PEER and p.retry_at_ <= now]
+
+    def num_usable(self):
+        return sum(1 for p in self.peers_.values() if p.failures_ == 0)
+
+    def want_more_peers(self):
+        return self.num_usable() < WANTED_CANDIDATES
+
+    def pick(self, n):
+        candidates = sorted(self.available(), key=lambda p: p.score(), reverse=True)[:n]
+        for peer in candidates:
+            peer.in_use_ += 1
+        return candidates
+
+    async def wait_for_change(self):
+        # Wake up when peers are added or released, or when a backoff might have expired
+        now = time.monotonic()
+        waiting = [p.retry_at_ - now for p in self.peers_.values() if p.retry_at_ > now]
+        self.changed_.clear()
+        try:
+            await asyncio.wait_for(self.changed_.wait(), min(waiting, default=BACKOFF_BASE))
+        except asyncio.TimeoutError:
+            pass
+
+    async def connect(self):
+        """
+        Dials up to DIAL_PARALLELISM of the best available peers at once and returns (address, reader, writer) of the
+        first one that accepts. Waits until some peer is available, so this only returns once it has a connection.
+        The returned peer is counted as in use until release or failed is called with it.
+        """
+        while True:
+            candidates = self.pick(DIAL_PARALLELISM)
+            if not candidates:
+                await self.wait_for_change()
+                continue
+
+            tasks = {asyncio.create_task(asyncio.wait_for(asyncio.open_connection(*p.address_), CONNECT_TIMEOUT)): p
+                     for p in candidates}
+            pending = set(tasks)
+            winner = None
+            try:
+                while pending and winner is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        peer = tasks[task]
+                        try:
+                            reader, writer = task.result()
+                        except (OSError, asyncio.TimeoutError):
+                            if self.debug_:
+                                print(f"Could not connect to {peer.address_}")
+                            self.failed(peer.address_)
+                            continue
+                        if winner is None:
+                            winner = (peer.address_, reader, writer)
+                        else:  # Another candidate answered at the same time, we only need one
+                            writer.close()
+                            self.release(peer.address_)
+            finally:
+                # Slower candidates aren't penalized, they just weren't needed this time
+                for task in pending:
+                    task.cancel()
+                    self.release(tasks[task].address_)
+            if winner:
+                return winner
+
+    def release(self, address, num_bytes=0, elapsed=None):
+        # Called when we are done with a connection to the peer, with how much we downloaded and how long it took
+        peer = self.peers_.get(address)
+        if not peer:
+            return
+        peer.in_use_ = max(peer.in_use_ - 1, 0)
+        if num_bytes and elapsed:
+            rate = num_bytes / elapsed
+            peer.rate_ = rate if peer.rate_ is None else (1 - RATE_SMOOTHING) * peer.rate_ + RATE_SMOOTHING * rate
+            peer.failures_ = 0
+            peer.retry_at_ = 0
+        self.changed_.set()
+
+    def failed(self, address):
+        # Called when dialing, handshaking or downloading from the peer did not work out
+        peer = self.peers_.get(address)
+        if not peer:
+            return
+        peer.in_use_ = max(peer.in_use_ - 1, 0)
+        peer.failures_ += 1
+        if peer.failures_ >= MAX_PEER_FAILURES and peer.in_use_ == 0:
+            if self.debug_:
+                print(f"Dropping peer {address}")
+            del self.peers_[address]
+        else:
+            peer.retry_at_ = time.monotonic() + BACKOFF_BASE * 2**(peer.failures_ - 1)
+        self.changed_.set()
+
+    def unhelpful(self, address):
+        # Called when the peer doesn't have any piece we need yet, which isn't its fault but is worth waiting on
+        peer = self.peers_.get(address)
+        if not peer:
+            return
+        peer.in_use_ = max(peer.in_use_ - 1, 0)
+        peer.retry_at_ = time.monotonic() + BACKOFF_BASE
+        self.changed_.set()
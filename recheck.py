@@ -0,0 +1,63 @@
+# Verifies a file on disk against the piece hashes of a torrent
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+HASH_LENGTH = 20  # SHA-1 digest size
+
+
+def hash_piece(fd, index, piece_length, total_length):
+    # hashlib releases the GIL while hashing large buffers and os.pread doesn't share a file position,
+    # so threads calling this in parallel use all cores without stepping on each other
+    length = min(piece_length, total_length - index * piece_length)
+    data = os.pread(fd, length, index * piece_length)
+    return index, len(data) == length and hashlib.sha1(data).digest()
+
+
+def recheck_file(path, info, workers=None, progress=None):
+    """
+    Hashes every piece of the file at `path` and compares it with info[b"pieces"].
+    Returns a bitfield (list of 0/1 like Manager.bitfield_) of the pieces that match, so a partial file can be resumed.
+    A missing file gives an empty bitfield. `progress(checked, total)` is called as pieces are checked.
+    Reads are streamed one piece per worker at a time, so memory use doesn't depend on the file size.
+    """
+    piece_length = info[b"piece length"]
+    total_length = info[b"length"]
+    hashes = info[b"pieces"]
+    num_pieces = len(hashes) // HASH_LENGTH
+    bitfield = [0] * num_pieces
+    if not os.path.exists(path):
+        if progress:
+            progress(num_pieces, num_pieces)
+        return bitfield
+
+    workers = workers or os.cpu_count() or 1
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        file_length = os.fstat(fd).st_size
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            next_index = 0
+            checked = 0
+            while next_index < num_pieces or pending:
+                # Keep a couple of pieces per worker in flight, so we don't queue the whole file at once
+                while next_index < num_pieces and len(pending) < 2 * workers:
+                    if next_index * piece_length >= file_length:  # Pieces past the end of the file are missing
+                        next_index = num_pieces
+                        break
+                    pending.add(executor.submit(hash_piece, fd, next_index, piece_length, total_length))
+                    next_index += 1
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, digest = future.result()
+                    bitfield[index] = int(digest == hashes[index * HASH_LENGTH:(index + 1) * HASH_LENGTH])
+                    checked += 1
+                if progress:
+                    progress(checked, num_pieces)
+    finally:
+        os.close(fd)
+    if progress and checked < num_pieces:  # Pieces past the end of a short file are checked too, they are missing
+        progress(num_pieces, num_pieces)
+    return bitfield
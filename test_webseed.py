@@ -0,0 +1,146 @@
+# Tests for web seed downloads against a local aiohttp file server, run with python -m pytest
+import asyncio
+import contextlib
+import hashlib
+import os
+from aiohttp import web
+import client
+from peers import PeerManager
+import webseed
+
+PIECE_LENGTH = 16384
+NAME = "payload.bin"
+
+
+def make_manager(data, web_seeds=None):
+    hashes = b"".join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH))
+    return client.Manager(PIECE_LENGTH, len(data), NAME, b"\0" * 20, "-TEST-", piece_hashes=hashes,
+                          web_seeds=web_seeds)
+
+
+@contextlib.asynccontextmanager
+async def serving(app):
+    # Serves app on a free port, yields its url and the list of Range headers of the requests it gets
+    requests = []
+
+    @web.middleware
+    async def record_request(request, handler):
+        requests.append(request.headers.get("Range"))
+        return await handler(request)
+
+    app.middlewares.append(record_request)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield f"http://127.0.0.1:{runner.addresses[0][1]}/", requests
+    finally:
+        await runner.cleanup()
+
+
+async def serve_and_run(app, manager, workers=1):
+    # Runs web seed workers against app until they stop, returns how many requests the server got
+    async with serving(app) as (url, requests):
+        async with webseed.create_session() as session:
+            seeds = [webseed.WebSeed(manager, url + NAME, session) for i in range(workers)]
+            await asyncio.gather(*[w.run() for w in seeds])
+    return len(requests)
+
+
+def static_app(directory):
+    app = web.Application()
+    app.add_routes([web.static("/", directory)])  # Supports Range requests
+    return app
+
+
+def test_range_download(tmp_path):
+    data = os.urandom(5 * PIECE_LENGTH + 1000)
+    (tmp_path / NAME).write_bytes(data)
+    manager = make_manager(data)
+    try:
+        asyncio.run(serve_and_run(static_app(tmp_path), manager, workers=2))
+        assert all(manager.bitfield_)
+        assert b"".join(manager.read_piece(i) for i in range(len(manager.bitfield_))) == data
+    finally:
+        manager.close_files()
+
+
+def test_server_ignoring_range(tmp_path):
+    data = os.urandom(5 * PIECE_LENGTH + 1000)
+
+    async def whole_file(request):
+        return web.Response(body=data)
+
+    app = web.Application()
+    app.add_routes([web.get(f"/{NAME}", whole_file)])
+    manager = make_manager(data)
+    try:
+        num_requests = asyncio.run(serve_and_run(app, manager))
+        # Gives up right away instead of downloading the whole file for every piece
+        assert num_requests == 1
+        assert not any(manager.bitfield_)
+        assert manager.pieces_left() == len(manager.bitfield_)
+    finally:
+        manager.close_files()
+
+
+def test_single_piece_file_without_range(tmp_path):
+    data = os.urandom(PIECE_LENGTH - 10)
+
+    async def whole_file(request):
+        return web.Response(body=data)
+
+    app = web.Application()
+    app.add_routes([web.get(f"/{NAME}", whole_file)])
+    manager = make_manager(data)
+    try:
+        asyncio.run(serve_and_run(app, manager))
+        assert manager.bitfield_ == [1]
+        assert manager.read_piece(0) == data
+    finally:
+        manager.close_files()
+
+
+def test_corrupt_data(tmp_path, monkeypatch):
+    monkeypatch.setattr(webseed, "BACKOFF_BASE", 0)
+    data = os.urandom(3 * PIECE_LENGTH)
+    corrupt = bytearray(data)
+    for i in range(0, len(corrupt), 1000):
+        corrupt[i] ^= 0xff
+    (tmp_path / NAME).write_bytes(bytes(corrupt))
+    manager = make_manager(data)
+    try:
+        num_requests = asyncio.run(serve_and_run(static_app(tmp_path), manager))
+        # Nothing is saved, and every piece is left for the peers
+        assert num_requests == webseed.MAX_WEB_SEED_FAILURES
+        assert not any(manager.bitfield_)
+        assert manager.pieces_left() == len(manager.bitfield_)
+    finally:
+        manager.close_files()
+
+
+def test_manager_waits_for_peers_after_corrupt_web_seed(tmp_path, monkeypatch):
+    # Peer connections stop while the web seed holds every piece, someone has to take over when it gives up
+    monkeypatch.setattr(webseed, "BACKOFF_BASE", 0)
+    monkeypatch.chdir(tmp_path)  # Where the manager writes the file
+    served = tmp_path / "served"
+    served.mkdir()
+    data = os.urandom(3 * PIECE_LENGTH)
+    (served / NAME).write_bytes(bytes(b ^ 0xff for b in data))
+
+    async def run():
+        async with serving(static_app(served)) as (url, requests):
+            manager = make_manager(data, web_seeds=[url])
+            manager.set_peer_manager(PeerManager())  # No peers, so the download can't finish
+            try:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(manager.run(), 1)
+                # Every web seed worker that got a piece gave up on it
+                assert len(requests) == len(manager.bitfield_) * webseed.MAX_WEB_SEED_FAILURES
+                assert not any(manager.bitfield_)
+            finally:
+                manager.close_files()
+
+    asyncio.run(run())
+    assert not (tmp_path / NAME).exists()
@@ -1,16 +1,77 @@
 # Implementation of a bittorrent tracker server
 import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import tempfile
 import urllib.parse
 import bencoding
+import collections.abc
 import random
+import signal
 import socket
+import time
 from aiohttp import web
+import metrics as metrics_module
+import trackerstate
 
 
-all_peers = set()
+class PeerSet(collections.abc.MutableSet):
+    # A set that can also sample its members without being copied, as announces would be slow with a large swarm
+
+    def __init__(self, peers=()):
+        self.peers_ = []
+        self.index_ = dict()  # peer -> its position in peers_
+        self.update(peers)
+
+    def __contains__(self, peer):
+        return peer in self.index_
+
+    def __iter__(self):
+        return iter(self.peers_)
+
+    def __len__(self):
+        return len(self.peers_)
+
+    def add(self, peer):
+        if peer not in self.index_:
+            self.index_[peer] = len(self.peers_)
+            self.peers_.append(peer)
+
+    def discard(self, peer):
+        # Move the last peer into the hole, so that removing is O(1)
+        i = self.index_.pop(peer, None)
+        if i is None:
+            return
+        last = self.peers_.pop()
+        if i < len(self.peers_):
+            self.peers_[i] = last
+            self.index_[last] = i
+
+    def update(self, peers):
+        for peer in peers:
+            self.add(peer)
+
+    def sample(self, k, exclude=None):
+        # Samples one extra so that we still have k if exclude is among them
+        indices = random.sample(range(len(self.peers_)), min(len(self.peers_), k + 1))
+        return [self.peers_[i] for i in indices if self.peers_[i] != exclude][:k]
+
+
+all_peers = PeerSet()
 completed_peers = set()  # Those who completed the download
 peer_2_trackerid = dict()
 next_trackerid = 0  # this should be a string when sent
+metrics = None  # metrics_module.Metrics when enabled with --metrics
+interval = 30  # seconds clients wait between requests, arbitrarily chosen, not sure what would be appropriate
+state_store = None  # trackerstate.StateStore when enabled with --state
+snapshot_interval = 10  # seconds between snapshots of the state
+state_client = None  # StateClient in worker processes, which don't keep the state themselves
+debug = False
+
+STATE_CONNECTIONS = 16  # connections each worker keeps open to the state process
+MAX_PEERS_GIVEN = 50  # peers handed out per announce
 
 
 # Converts aiohttp-structured data into dictionary
@@ -23,65 +84,328 @@ def extract_request_parameters(param_dict):
     return d
 
 
-def sample_peers():
-    sample = random.sample(tuple(completed_peers), min(len(completed_peers), 50))  # sampling from set is deprecated
+def sample_peers(requester):
+    # Peers upload the pieces they have while downloading, so every peer but the requester is useful
+    sample = all_peers.sample(MAX_PEERS_GIVEN, exclude=requester)
     compact = ""
-    print(f"Giving peers: {sample}")
+    if debug:
+        print(f"Giving peers: {sample}")
     # put peers in compact form
     for ip, port in sample:
-        nums = ip.split(".") + [port]
-        for num in nums:
+        for num in ip.split("."):
             n = hex(int(num))[2:]
             compact += "0"*(2-len(n))+n  # len(n) can be one, but we need it to be 2
+        n = hex(int(port))[2:]
+        compact += "0"*(4-len(n))+n  # ports take 4 hex digits
     return compact
 
 
-async def request_handler(request):
+def collect_swarm_sizes(m):
+    m.set("bittorrent_tracker_peers", len(all_peers))
+    m.set("bittorrent_tracker_seeders", len(completed_peers))
+
+
+def restore_state():
     global next_trackerid
+    start = time.perf_counter()
+    state = state_store.load()
+    if state:
+        restored_all, restored_completed, restored_ids, next_trackerid = state
+        all_peers.update(restored_all)
+        completed_peers.update(restored_completed)
+        peer_2_trackerid.update(restored_ids)
+    print(f"Restored {len(all_peers)} peers in {(time.perf_counter() - start) * 1000:.1f} ms")
 
-    # Extract the request parameters
-    params_urlencoded = request.query
-    params = extract_request_parameters(params_urlencoded)
-    peer = (request.remote, params["port"])  # ip addr and port pair
-    print(f"Received request from {peer}")
+
+def save_state():
+    state_store.save(all_peers, completed_peers, peer_2_trackerid, next_trackerid)
+
+
+async def save_state_in_background():
+    # Copying the state is quick, but encoding and writing a large swarm isn't, so that happens off the event loop
+    position = state_store.log_position()
+    state = (set(all_peers), set(completed_peers), dict(peer_2_trackerid), next_trackerid)
+    await asyncio.to_thread(state_store.write_snapshot, *state)
+    state_store.drop_log_before(position)
+
+
+async def snapshot_periodically():
+    while True:
+        await asyncio.sleep(snapshot_interval)
+        save = asyncio.create_task(save_state_in_background())
+        try:
+            await asyncio.shield(save)
+        except asyncio.CancelledError:
+            # Shutting down. The thread can't be stopped, so wait for it before the final snapshot is written
+            with contextlib.suppress(Exception):
+                await save
+            raise
+        except Exception as e:  # Keep snapshotting, the next one might work (eg. after disk space is freed)
+            print(f"Could not save the tracker state: {e!r}")
+
+
+@contextlib.asynccontextmanager
+async def persisting_state():
+    # Snapshots while the server runs, and once more when it shuts down
+    state_store.open_log()
+    task = asyncio.create_task(snapshot_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        save_state()
+        state_store.close()
+
+
+async def persist_state(app):
+    # aiohttp cleanup context
+    async with persisting_state():
+        yield
+
+
+def announce(peer, event=None, trackerid=None):
+    # Updates the swarm with an announce from peer and returns the text of the response
+    global next_trackerid
 
     # Form response
     payload = {"complete": len(completed_peers),
                "incomplete": len(all_peers)-len(completed_peers),
-               "peers": sample_peers(),
-               "interval": 30  # arbitrarily chosen, not sure what would be appropriate
+               "peers": sample_peers(peer),
+               "interval": interval
     }
 
     # Wrong trackerid
-    if "trackerid" in params and peer_2_trackerid[peer] != params["trackerid"]:
-        return web.Response(text="trackerid of existing peer doesn't match with what is recorded.")
+    if trackerid is not None and peer_2_trackerid.get(peer) != trackerid:
+        return "trackerid of existing peer doesn't match with what is recorded."
 
     # Special request?
-    if "event" in params:
-        event = params["event"]
+    if event == "started":
+        peer_2_trackerid[peer] = str(next_trackerid)
+        next_trackerid += 1
+        all_peers.add(peer)
+        if state_store:
+            state_store.append(trackerstate.STARTED, peer, next_trackerid - 1)
 
-        if event == "started":
-            peer_2_trackerid[peer] = str(next_trackerid)
-            next_trackerid += 1
-            all_peers.add(peer)
+    elif event == "stopped":
+        all_peers.discard(peer)
+        completed_peers.discard(peer)
+        if state_store:
+            state_store.append(trackerstate.STOPPED, peer)
 
-        elif event == "stopped":
-            all_peers.discard(peer)
-            completed_peers.discard(peer)
+    elif event == "completed":
+        completed_peers.add(peer)
+        if state_store:
+            state_store.append(trackerstate.COMPLETED_EVENT, peer)
 
-        elif event == "completed":
-            completed_peers.add(peer)
+    return urllib.parse.urlencode(payload)
 
-    params = urllib.parse.urlencode(payload)
-    return web.Response(text=params)
+
+async def request_handler(request):
+    if metrics:
+        start = time.perf_counter()
+
+    # Extract the request parameters
+    params_urlencoded = request.query
+    params = extract_request_parameters(params_urlencoded)
+    port = params.get("port", "")
+    if not (port.isascii() and port.isdecimal()) or int(port) > 65535:
+        # Such a peer would be useless to others, and couldn't be saved with --state
+        return web.Response(status=400, text="port should be a number between 0 and 65535.")
+    peer = (request.remote, str(int(port)))  # ip addr and port pair
+    if debug:
+        print(f"Received request from {peer}")
+
+    if state_client:
+        text = await state_client.announce(peer, params.get("event"), params.get("trackerid"))
+    else:
+        text = announce(peer, params.get("event"), params.get("trackerid"))
+
+    if metrics:
+        metrics.inc("bittorrent_tracker_announces_total", event=params.get("event", "none"))
+        metrics.observe("bittorrent_tracker_request_seconds", time.perf_counter() - start)
+    return web.Response(text=text)
+
+
+def make_app():
+    app = web.Application()
+    app.add_routes([web.get('/', request_handler)])
+    if metrics:
+        app.add_routes([web.get('/metrics', metrics.handler)])
+    return app
+
+
+# Running with several worker processes (--workers)
+# The workers share the listening port (SO_REUSEPORT, so the kernel spreads connections between them) and parse the
+# requests, while a single state process owns the swarm and answers their announces over a unix socket.
+# Messages in both directions are bencoded and prefixed with their length (4 bytes).
+
+async def write_frame(writer, message):
+    data = bencoding.encode(message)
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+
+
+async def read_frame(reader):
+    length = int.from_bytes(await reader.readexactly(4), "big")
+    return bencoding.decode(await reader.readexactly(length))
+
+
+async def handle_state_connection(reader, writer):
+    # In the state process, one of these runs for every connection from a worker
+    try:
+        while True:
+            request = await read_frame(reader)
+            peer = (request[b"ip"].decode(), request[b"port"].decode())
+            event = request[b"event"].decode() if b"event" in request else None
+            trackerid = request[b"trackerid"].decode() if b"trackerid" in request else None
+            await write_frame(writer, {b"text": announce(peer, event, trackerid).encode()})
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        pass  # The worker went away, or we are shutting down
+    except Exception as e:  # The worker gets an error for this announce, and opens a new connection for the next
+        print(f"Failed to handle an announce: {e!r}")
+    finally:
+        writer.close()
+
+
+async def serve_state(socket_path):
+    # Stops on SIGTERM or Ctrl-C, here rather than with a KeyboardInterrupt in the middle of whatever is running
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    server = await asyncio.start_unix_server(handle_state_connection, socket_path)
+    async with server:
+        if state_store:
+            async with persisting_state():
+                await stop.wait()
+        else:
+            await stop.wait()
+
+
+class StateClient:
+    # Used by worker processes to send announces to the state process, over a small pool of connections
+
+    def __init__(self, socket_path, size=STATE_CONNECTIONS):
+        self.socket_path_ = socket_path
+        self.size_ = size
+        self.opened_ = 0
+        self.pool_ = asyncio.Queue()  # Idle (reader, writer) pairs
+
+    async def get_connection(self):
+        if self.pool_.empty() and self.opened_ < self.size_:
+            self.opened_ += 1
+            try:
+                return await asyncio.open_unix_connection(self.socket_path_)
+            except OSError:
+                self.opened_ -= 1
+                raise
+        return await self.pool_.get()
+
+    async def announce(self, peer, event=None, trackerid=None):
+        request = {b"ip": peer[0].encode(), b"port": str(peer[1]).encode()}
+        if event:
+            request[b"event"] = event.encode()
+        if trackerid is not None:
+            request[b"trackerid"] = trackerid.encode()
+        reader, writer = await self.get_connection()
+        try:
+            await write_frame(writer, request)
+            response = await read_frame(reader)
+        except BaseException:
+            # We don't know where the stream stands anymore, so don't reuse the connection
+            writer.close()
+            self.opened_ -= 1
+            raise
+        self.pool_.put_nowait((reader, writer))
+        return response[b"text"].decode()
+
+
+def run_state_process(socket_path):
+    try:
+        asyncio.run(serve_state(socket_path))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_worker(host, port, socket_path, worker_id):
+    async def start_client(app):
+        global state_client
+        state_client = StateClient(socket_path)  # Needs to be created in the worker's event loop
+
+    app = make_app()
+    app.on_startup.append(start_client)
+    try:
+        web.run_app(app, host=host, port=port, reuse_port=True, print=print if worker_id == 0 else None)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(host, port, num_workers):
+    # Like Ctrl-C, SIGTERM makes every process shut down cleanly (the forked processes inherit the handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    socket_dir = tempfile.mkdtemp(prefix="bittorrent-tracker-")
+    socket_path = os.path.join(socket_dir, "state.sock")
+    state_process = multiprocessing.Process(target=run_state_process, args=(socket_path,))
+    state_process.start()
+    while not os.path.exists(socket_path) and state_process.is_alive():  # Workers need the state process to be up
+        time.sleep(0.01)
+    workers = [multiprocessing.Process(target=run_worker, args=(host, port, socket_path, i))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Workers first, so that the announces they are handling still reach the state process
+        for process in workers + [state_process]:
+            if process.is_alive():
+                process.terminate()
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+        with contextlib.suppress(OSError):
+            os.remove(socket_path)
+            os.rmdir(socket_dir)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--ip", default=None, help="ip address for client")
     parser.add_argument("-p", "--port", type=int, default=42421, help="port for client")
+    parser.add_argument("--metrics", action="store_true", help="serve Prometheus metrics at /metrics")
+    parser.add_argument("--interval", type=int, default=30, help="seconds clients should wait between requests")
+    parser.add_argument("--state", default=None, help="file to snapshot the swarm to, and restore it from on start")
+    parser.add_argument("--state-log", action="store_true",
+                        help="also append every change to STATE.log, so nothing since the last snapshot is lost")
+    parser.add_argument("--snapshot-interval", type=int, default=10, help="seconds between snapshots")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="processes sharing the port, with the swarm kept in a separate state process if more "
+                             "than 1")
+    parser.add_argument("-d", "--debug", action="store_true", help="print every request")
     args = parser.parse_args()
+    interval = args.interval
+    debug = args.debug
 
-    app = web.Application()
-    app.add_routes([web.get('/', request_handler)])
-    web.run_app(app, host=args.ip, port=args.port)
+    if args.metrics:
+        metrics = metrics_module.tracker_metrics()
+        if args.workers == 1:  # Workers don't see the swarm, only the state process does
+            metrics.add_collector(collect_swarm_sizes)
+    if args.state:
+        state_store = trackerstate.StateStore(args.state, log=args.state_log)
+        snapshot_interval = args.snapshot_interval
+        restore_state()
+
+    if args.workers > 1:
+        # The state process and workers are forked, so they inherit everything set up above
+        multiprocessing.set_start_method("fork")
+        run_workers(args.ip, args.port, args.workers)
+    else:
+        app = make_app()
+        if state_store:
+            app.cleanup_ctx.append(persist_state)
+        web.run_app(app, host=args.ip, port=args.port)
@@ -0,0 +1,143 @@
+# Load generator for the tracker, measuring announce throughput and latency as the number of workers grows
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRACKER_IP = "127.0.0.1"
+COMPLETE_PROBABILITY = 0.05  # chance that a regular announce reports the download as completed
+INFO_HASH = urllib.parse.quote_from_bytes(b"tracker-benchmark-ih")  # The tracker serves a single swarm, any 20 bytes do
+
+
+def announce_url(port, peer_port, event=None):
+    params = {"info_hash": INFO_HASH, "peer_id": f"-BENCH-{peer_port:013d}", "port": peer_port, "uploaded": 0,
+              "downloaded": 0, "left": 0, "compact": 1}
+    if event:
+        params["event"] = event
+    # info_hash is already escaped
+    return f"http://{TRACKER_IP}:{port}/?" + "&".join(f"{key}={val}" for key, val in params.items())
+
+
+async def simulated_peer(session, port, peer_port, deadline, latencies, errors):
+    # Starts, then announces again right away (clients would wait for the interval) until the deadline
+    event = "started"
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            async with session.get(announce_url(port, peer_port, event)) as response:
+                await response.read()
+                if response.status != 200:
+                    errors[0] += 1
+                    continue
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            errors[0] += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+        event = "completed" if random.random() < COMPLETE_PROBABILITY else None
+
+
+async def generate_load(port, first_peer_port, concurrency, duration):
+    latencies = []
+    errors = [0]
+    deadline = time.monotonic() + duration
+    # The pool is as large as the number of simulated peers, so no request waits for a free connection
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10)) as session:
+        await asyncio.gather(*[simulated_peer(session, port, first_peer_port + i, deadline, latencies, errors)
+                               for i in range(concurrency)])
+    return latencies, errors[0]
+
+
+def run_generator(port, first_peer_port, concurrency, duration):
+    # Runs in its own process, so that the load generator doesn't become the bottleneck
+    return asyncio.run(generate_load(port, first_peer_port, concurrency, duration))
+
+
+def wait_for_port(port, process, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with socket.create_connection((TRACKER_IP, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def measure(workers, *, port=42421, generators=2, concurrency=64, duration=10.0, warmup=1.0, debug=False):
+    tracker = subprocess.Popen([sys.executable, os.path.join(HERE, "tracker.py"), "--ip", TRACKER_IP, "-p", str(port),
+                                "--workers", str(workers)],
+                               stdout=None if debug else subprocess.DEVNULL,
+                               stderr=None if debug else subprocess.DEVNULL)
+    try:
+        if not wait_for_port(port, tracker):
+            raise RuntimeError(f"Tracker with {workers} workers did not start")
+        time.sleep(warmup)  # With several workers, the port accepts connections before every worker listens on it
+        with concurrent.futures.ProcessPoolExecutor(generators) as pool:
+            # Every simulated peer gets its own port, 4096 and up
+            futures = [pool.submit(run_generator, port, 4096 + i * concurrency, concurrency, duration)
+                       for i in range(generators)]
+            results = [future.result() for future in futures]
+    finally:
+        tracker.send_signal(signal.SIGTERM)
+        try:
+            tracker.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            tracker.kill()
+            tracker.wait()
+
+    latencies = sorted(latency for result_latencies, _ in results for latency in result_latencies)
+    return {
+        "workers": workers,
+        "announces": len(latencies),
+        "announces_per_second": len(latencies) / duration,
+        "errors": sum(errors for _, errors in results),
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="numbers of tracker workers to measure, one run each")
+    parser.add_argument("-p", "--port", type=int, default=42421, help="port for the tracker")
+    parser.add_argument("-g", "--generators", type=int, default=2, help="load generating processes")
+    parser.add_argument("-c", "--concurrency", type=int, default=64,
+                        help="simulated peers announcing at once in each generator")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load for each number of workers")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON report here instead of stdout")
+    parser.add_argument("-d", "--debug", action="store_true", help="show tracker output")
+    args = parser.parse_args()
+
+    report = {
+        "cpus": os.cpu_count(),
+        "generators": args.generators,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "runs": [measure(workers, port=args.port, generators=args.generators, concurrency=args.concurrency,
+                         duration=args.duration, debug=args.debug) for workers in args.workers],
+    }
+    report["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True,
+                                      text=True).stdout.strip() or None
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
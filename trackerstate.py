@@ -0,0 +1,184 @@
+# Saving and restoring the tracker's swarm state, so that restarting the tracker doesn't empty the swarm
+import os
+import struct
+
+MAGIC = b"BTTS"  # BitTorrent Tracker Snapshot
+VERSION = 1
+HEADER = struct.Struct(">4sBQI")  # magic, version, next_trackerid, number of peers
+PEER = struct.Struct(">BHBQ")  # ip length, port, flags, trackerid (ip bytes follow)
+
+# Peer flags
+IN_SWARM = 1  # in all_peers
+COMPLETED = 2  # in completed_peers
+HAS_TRACKERID = 4  # in peer_2_trackerid
+
+# Append log operations, one per event the tracker handles
+STARTED = 1
+STOPPED = 2
+COMPLETED_EVENT = 3
+LOG_RECORD = struct.Struct(">BBHQ")  # operation, ip length, port, trackerid (ip bytes follow)
+
+
+class TrackerStateError(Exception):
+    pass
+
+
+def encode_peer(peer, flags, trackerid):
+    # The tracker keeps the port as the string it received, but storing it as a number is more compact
+    ip = peer[0].encode()
+    return PEER.pack(len(ip), int(peer[1]), flags, trackerid) + ip
+
+
+def encode_snapshot(all_peers, completed_peers, peer_2_trackerid, next_trackerid):
+    peers = all_peers | completed_peers | peer_2_trackerid.keys()
+    chunks = [HEADER.pack(MAGIC, VERSION, next_trackerid, len(peers))]
+    for peer in peers:
+        flags = (IN_SWARM if peer in all_peers else 0) | (COMPLETED if peer in completed_peers else 0)
+        trackerid = 0
+        if peer in peer_2_trackerid:
+            flags |= HAS_TRACKERID
+            trackerid = int(peer_2_trackerid[peer])
+        chunks.append(encode_peer(peer, flags, trackerid))
+    return b"".join(chunks)
+
+
+def decode_snapshot(data):
+    # Returns (all_peers, completed_peers, peer_2_trackerid, next_trackerid) in the form tracker.py keeps them
+    if len(data) < HEADER.size:
+        raise TrackerStateError("Snapshot is too short")
+    magic, version, next_trackerid, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise TrackerStateError(f"Not a version {VERSION} tracker snapshot")
+    all_peers = set()
+    completed_peers = set()
+    peer_2_trackerid = dict()
+    offset = HEADER.size
+    for i in range(count):
+        ip_length, port, flags, trackerid = PEER.unpack_from(data, offset)
+        offset += PEER.size
+        peer = (data[offset:offset+ip_length].decode(), str(port))
+        offset += ip_length
+        if flags & IN_SWARM:
+            all_peers.add(peer)
+        if flags & COMPLETED:
+            completed_peers.add(peer)
+        if flags & HAS_TRACKERID:
+            peer_2_trackerid[peer] = str(trackerid)
+    if offset != len(data):
+        raise TrackerStateError("Snapshot has trailing data")
+    return all_peers, completed_peers, peer_2_trackerid, next_trackerid
+
+
+def encode_log_record(operation, peer, trackerid=0):
+    ip = peer[0].encode()
+    return LOG_RECORD.pack(operation, len(ip), int(peer[1]), trackerid) + ip
+
+
+def replay_log(data, all_peers, completed_peers, peer_2_trackerid, next_trackerid):
+    """
+    Applies the records of an append log to the given state (in place), returns the new next_trackerid.
+    Replaying a record that is already reflected in the state changes nothing, so it is fine if the log overlaps with
+    the snapshot. A record cut short by a crash is ignored.
+    """
+    offset = 0
+    while offset + LOG_RECORD.size <= len(data):
+        operation, ip_length, port, trackerid = LOG_RECORD.unpack_from(data, offset)
+        if offset + LOG_RECORD.size + ip_length > len(data):
+            break
+        offset += LOG_RECORD.size
+        peer = (data[offset:offset+ip_length].decode(), str(port))
+        offset += ip_length
+        if operation == STARTED:
+            peer_2_trackerid[peer] = str(trackerid)
+            all_peers.add(peer)
+            next_trackerid = max(next_trackerid, trackerid + 1)
+        elif operation == STOPPED:
+            all_peers.discard(peer)
+            completed_peers.discard(peer)
+        elif operation == COMPLETED_EVENT:
+            completed_peers.add(peer)
+        else:
+            raise TrackerStateError(f"Unknown log operation {operation}")
+    return next_trackerid
+
+
+def write_atomically(path, data):
+    # Write to a temporary file and rename it over the old one, so a crash leaves either the old or the new snapshot
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class StateStore:
+    """
+    Keeps a snapshot file, and optionally an append log of the changes since the snapshot.
+    On boot, load() reads the snapshot and replays the log on top of it.
+    """
+
+    def __init__(self, snapshot_path, log=False):
+        self.snapshot_path_ = snapshot_path
+        self.log_path_ = f"{snapshot_path}.log" if log else None
+        self.log_file_ = None
+
+    def load(self):
+        # Returns the state as decode_snapshot does, or None if there is nothing saved
+        state = None
+        if os.path.exists(self.snapshot_path_):
+            with open(self.snapshot_path_, "rb") as f:
+                state = decode_snapshot(f.read())
+        if self.log_path_ and os.path.exists(self.log_path_):
+            with open(self.log_path_, "rb") as f:
+                data = f.read()
+            if data:
+                all_peers, completed_peers, peer_2_trackerid, next_trackerid = state or (set(), set(), dict(), 0)
+                next_trackerid = replay_log(data, all_peers, completed_peers, peer_2_trackerid, next_trackerid)
+                state = all_peers, completed_peers, peer_2_trackerid, next_trackerid
+        return state
+
+    def open_log(self):
+        if self.log_path_:
+            self.log_file_ = open(self.log_path_, "ab")
+
+    def append(self, operation, peer, trackerid=0):
+        # Flushed right away so that it survives the tracker process crashing (but not necessarily the machine)
+        if self.log_file_:
+            self.log_file_.write(encode_log_record(operation, peer, trackerid))
+            self.log_file_.flush()
+
+    def log_position(self):
+        # Records before this position in the log are reflected in the state as it is now
+        return self.log_file_.tell() if self.log_file_ else 0
+
+    def write_snapshot(self, all_peers, completed_peers, peer_2_trackerid, next_trackerid):
+        # Doesn't touch the log, so it can run in another thread on a copy of the state
+        write_atomically(self.snapshot_path_, encode_snapshot(all_peers, completed_peers, peer_2_trackerid,
+                                                              next_trackerid))
+
+    def drop_log_before(self, position):
+        # Called once the snapshot of the state at position is written. If we crash before this, replaying the records
+        # again is harmless
+        if not self.log_file_:
+            return
+        with open(self.log_path_, "rb") as f:
+            f.seek(position)
+            rest = f.read()  # Appended while the snapshot was being written
+        if rest:
+            self.log_file_.close()
+            write_atomically(self.log_path_, rest)
+            self.log_file_ = open(self.log_path_, "ab")
+        else:
+            self.log_file_.truncate(0)
+            self.log_file_.flush()
+
+    def save(self, all_peers, completed_peers, peer_2_trackerid, next_trackerid):
+        position = self.log_position()
+        self.write_snapshot(all_peers, completed_peers, peer_2_trackerid, next_trackerid)
+        self.drop_log_before(position)
+
+    def close(self):
+        if self.log_file_:
+            self.log_file_.close()
+            self.log_file_ = None
@@ -0,0 +1,92 @@
+# Downloading pieces from HTTP servers that have the file (BEP 19 web seeds)
+import asyncio
+import time
+import aiohttp
+
+WEB_SEED_CONNECTIONS = 4  # parallel requests per web seed, they share pooled keep-alive connections
+WEB_SEED_TIMEOUT = 30  # seconds for a single range request
+MAX_WEB_SEED_FAILURES = 5  # consecutive failures after which a worker gives up on its web seed
+BACKOFF_BASE = 1  # seconds, doubled after every consecutive failure
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+def create_session():
+    # One session for all web seeds, so that connections to the same server are reused between pieces
+    connector = aiohttp.TCPConnector(limit_per_host=WEB_SEED_CONNECTIONS)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=WEB_SEED_TIMEOUT))
+
+
+def file_url(url, name):
+    # BEP 19: a url ending with "/" is a directory that contains the file
+    if url.endswith("/"):
+        return url + name
+    return url
+
+
+class WebSeed:
+    """
+    Downloads pieces from an HTTP server with Range requests. Every piece is available there, so a web seed worker
+    takes any piece the manager hasn't assigned yet, and hands it to the manager to be verified like pieces from peers.
+    """
+
+    def __init__(self, manager, url, session, debug=False, metrics=None):
+        self.manager_ = manager
+        self.url_ = url
+        self.session_ = session
+        self.debug_ = debug
+        self.metrics_ = metrics
+        self.failures_ = 0
+        self.all_pieces_ = [1] * len(manager.bitfield_)
+
+    async def fetch(self, index):
+        start = index * self.manager_.piece_length_
+        end = min(start + self.manager_.piece_length_, self.manager_.total_length_) - 1  # Range end is inclusive
+        headers = {"Range": f"bytes={start}-{end}"}
+        async with self.session_.get(self.url_, headers=headers) as response:
+            if response.status == 206:
+                data = await response.read()
+            elif response.status == 200 and self.manager_.total_length_ > self.manager_.piece_length_:
+                # The server ignored the range. Reading the whole file for every piece isn't worth it, so don't
+                raise RangeNotSupported(f"{self.url_} doesn't support Range requests")
+            elif response.status == 200 and response.content_length == self.manager_.total_length_:
+                data = await response.read()  # The file is a single piece, so this is what we asked for anyway
+            else:
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                  message="Unexpected status for a range request")
+        if len(data) != end - start + 1:
+            raise aiohttp.ClientPayloadError(f"Expected {end - start + 1} bytes, got {len(data)}")
+        return data
+
+    async def run(self):
+        while self.manager_.pieces_left() and self.failures_ < MAX_WEB_SEED_FAILURES:
+            index = self.manager_.get_assignment(self.all_pieces_)
+            if index is None:
+                return
+            started = time.perf_counter()
+            try:
+                data = await self.fetch(index)
+            except RangeNotSupported as e:
+                if self.debug_:
+                    print(f"Giving up on web seed: {e}")
+                self.manager_.return_assignment(index)
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if self.debug_:
+                    print(f"Web seed {self.url_} failed on piece {index}: {e!r}")
+                self.manager_.return_assignment(index)
+                self.failures_ += 1
+                await asyncio.sleep(BACKOFF_BASE * 2**(self.failures_ - 1))
+                continue
+            if self.metrics_:
+                self.metrics_.observe("bittorrent_webseed_request_seconds", time.perf_counter() - started)
+                self.metrics_.inc("bittorrent_webseed_bytes_total", len(data), url=self.url_)
+            if self.manager_.store_piece(index, data):
+                self.failures_ = 0
+            else:  # The server has a different file
+                self.manager_.return_assignment(index)
+                self.failures_ += 1
+        if self.debug_ and self.failures_ >= MAX_WEB_SEED_FAILURES:
+            print(f"Giving up on web seed {self.url_}")